@@ -1,21 +1,165 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Blueprint, Flask, Request, Response, current_app, request, jsonify, render_template_string
+import io
+import json
+import math
 import os
+import queue
+import threading
+from typing import Dict
 from werkzeug.utils import secure_filename
-import tempfile
+from werkzeug.exceptions import HTTPException
 
-from processor import DocumentProcessor
-from classify import DocumentClassifier
-from main import DocumentAnalyzer
-import requests
+from main import DocumentAnalyzer, ANALYSIS_MODES
+from jobs import JobStore, JobQueue, QueueFullError
+from metrics import REGISTRY, StageTimer
+from config import load_config, llama_server_urls
 import logging
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+PDF_MAGIC = b"%PDF-"
+PDF_MAGIC_SEARCH_BYTES = 1024  # Header PDF có thể nằm trong 1024 byte đầu
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-# Khởi tạo analyzer
-analyzer = DocumentAnalyzer("http://localhost:8080")
+# error_kind của kết quả phân tích -> HTTP status, để client/load balancer phân biệt
+# request bị từ chối do quá tải (thử lại sau Retry-After) với llama-server lỗi
+ERROR_KIND_STATUS = {"overloaded": 429, "unavailable": 503, "llm_error": 502}
 
-@app.route('/')
+class UploadError(Exception):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class PdfUploadBuffer(io.BytesIO):
+    """Buffer của một file multipart: kiểm tra magic bytes PDF ngay khi nhận đủ phần đầu
+
+    UploadError ném ra từ write() dừng việc parse form, nên file không phải PDF bị
+    từ chối (400) sau khoảng 1KB thay vì sau khi đã đệm cả file. File ngắn hơn
+    PDF_MAGIC_SEARCH_BYTES được kiểm tra lại trong read_upload_file.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._head = b""  # None: đã kiểm tra xong
+
+    def write(self, data) -> int:
+        if self._head is not None:
+            self._head += bytes(data[:PDF_MAGIC_SEARCH_BYTES - len(self._head)])
+            if len(self._head) >= PDF_MAGIC_SEARCH_BYTES:
+                check_pdf_header(self._head)
+                self._head = None
+        return super().write(data)
+
+class InMemoryRequest(Request):
+    """Giữ file upload trong bộ nhớ thay vì SpooledTemporaryFile (ghi ra đĩa khi > 500KB)"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and not filename.lower().endswith('.pdf'):
+            raise UploadError(f"Chỉ chấp nhận file PDF: {filename}")
+        return PdfUploadBuffer()
+
+def build_analyzer(config: Dict) -> DocumentAnalyzer:
+    return DocumentAnalyzer(
+        llama_server_urls(config),
+        cache_path=config["RESULT_CACHE_PATH"] or None,
+        prefilter_path=config["PREFILTER_PATH"] or None,
+        prefilter_threshold=config["PREFILTER_THRESHOLD"],
+        dedup_path=config["DEDUP_PATH"] or None,
+        batch_max_size=config["BATCH_MAX_SIZE"],
+        batch_max_wait_ms=config["BATCH_MAX_WAIT_MS"],
+        llm_slots=config["LLAMA_SLOTS"],
+        early_stop=config["EARLY_STOP"],
+        taxonomy_path=config["TAXONOMY_PATH"] or None,
+        ocr_workers=config["OCR_WORKERS"],
+        ocr_options={
+            "dpi": config["OCR_DPI"],
+            "lang": config["OCR_LANG"],
+            "top_ratio": config["OCR_TOP_RATIO"],
+            "timeout": config["OCR_TIMEOUT"]
+        },
+        adaptive_concurrency=config["LLAMA_ADAPTIVE_CONCURRENCY"],
+        limiter_options={
+            "target_queue_ms": config["LLAMA_TARGET_QUEUE_MS"],
+            # Giữ độ trễ dưới nửa read timeout để request không bị timeout phía client
+            "target_latency_ms": config["LLAMA_READ_TIMEOUT"] * 1000 / 2,
+            "max_limit": config["LLAMA_MAX_CONCURRENCY"],
+            "queue_timeout": config["LLAMA_QUEUE_TIMEOUT"]
+        },
+        client_options={
+            "connect_timeout": config["LLAMA_CONNECT_TIMEOUT"],
+            "read_timeout": config["LLAMA_READ_TIMEOUT"],
+            "pool_size": config["LLAMA_POOL_SIZE"],
+            "max_retries": config["LLAMA_MAX_RETRIES"]
+        }
+    )
+
+class Services:
+    """Analyzer + hàng đợi job của process worker hiện tại
+
+    Được tạo ở request đầu tiên chứ không phải khi import/create_app, nên mỗi
+    worker có bộ riêng (kết nối SQLite, HTTP pool, thread) và khởi động nhanh.
+    Nếu process bị fork sau khi đã tạo (pid khác) thì tạo lại trong process con.
+    """
+
+    def __init__(self, config: Dict, analyzer: DocumentAnalyzer = None):
+        self.config = config
+        self._injected_analyzer = analyzer
+        self._analyzer = analyzer
+        self._job_queue = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._analyzer = self._injected_analyzer
+            self._job_queue = None
+
+    def existing(self) -> tuple:
+        """(analyzer, job_queue) đã tạo trong process này, None nếu chưa có; không tạo mới"""
+        self._check_fork()
+        return self._analyzer, self._job_queue
+
+    @property
+    def analyzer(self) -> DocumentAnalyzer:
+        self._check_fork()
+        if self._analyzer is None:
+            with self._lock:
+                if self._analyzer is None:
+                    self._analyzer = build_analyzer(self.config)
+        return self._analyzer
+
+    @property
+    def job_queue(self) -> JobQueue:
+        self._check_fork()
+        if self._job_queue is None:
+            analyzer = self.analyzer
+            with self._lock:
+                if self._job_queue is None:
+                    # Hàng đợi job bất đồng bộ, kết quả lưu trong SQLite (dùng chung giữa các worker)
+                    self._job_queue = JobQueue(analyzer, JobStore(self.config["JOBS_DB_PATH"]),
+                                               workers=self.config["JOB_WORKERS"],
+                                               max_queue=self.config["JOB_MAX_QUEUE"])
+        return self._job_queue
+
+def get_services() -> Services:
+    return current_app.extensions["document_services"]
+
+bp = Blueprint("documents", __name__)
+
+def create_app(config: Dict = None, analyzer: DocumentAnalyzer = None) -> Flask:
+    """WSGI app factory, ví dụ: gunicorn -w 1 -k gthread --threads 16 'app:create_app()'
+
+    config ghi đè lên cấu hình đọc từ biến môi trường (xem config.py).
+    """
+    config = load_config(**(config or {}))
+    app = Flask(__name__)
+    app.request_class = InMemoryRequest
+    app.config.update(config)
+    app.extensions["document_services"] = Services(config, analyzer)
+    app.register_blueprint(bp)
+    return app
+
+@bp.route('/')
 def index():
     return render_template_string('''
     <!DOCTYPE html>
@@ -29,51 +173,273 @@ def index():
         <form action="/classify" method="post" enctype="multipart/form-data">
             <input type="file" name="document" accept=".pdf" required>
             <br><br>
+            <select name="mode">
+                <option value="summarize">Tóm tắt rồi phân loại</option>
+                <option value="direct">Phân loại trực tiếp (nhanh hơn)</option>
+                <option value="constrained">Chỉ nhãn + xác suất (nhanh nhất)</option>
+            </select>
+            <br><br>
             <button type="submit">Phân loại</button>
         </form>
     </body>
     </html>
     ''')
 
-@app.route('/classify', methods=['POST'])
+def check_pdf_header(head: bytes):
+    if PDF_MAGIC not in head[:PDF_MAGIC_SEARCH_BYTES]:
+        raise UploadError("Chỉ chấp nhận file PDF")
+
+def read_pdf_stream(stream, max_bytes: int) -> bytes:
+    """Đọc PDF từ stream theo từng khối vào bộ nhớ
+
+    Đọc và kiểm tra magic bytes ở phần đầu trước, dừng ngay khi vượt max_bytes,
+    nên body sai định dạng/quá lớn bị từ chối trước khi đọc hết. Các khối được
+    ghi vào một BytesIO và trả về bằng getvalue() (dùng chung bộ nhớ, không copy).
+    """
+    head = b""
+    while len(head) < PDF_MAGIC_SEARCH_BYTES:
+        chunk = stream.read(PDF_MAGIC_SEARCH_BYTES - len(head))
+        if not chunk:
+            break
+        head += chunk
+    check_pdf_header(head)
+    
+    buffer = io.BytesIO()
+    buffer.write(head)
+    while True:
+        if buffer.tell() > max_bytes:
+            raise UploadError("File quá lớn", 413)
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return buffer.getvalue()
+        buffer.write(chunk)
+
+def read_upload_file(file, max_bytes: int) -> bytes:
+    """PDF từ một file multipart
+
+    Với InMemoryRequest, Werkzeug đã đệm cả file trong PdfUploadBuffer (phần đầu đã
+    được kiểm tra trong lúc parse): kiểm tra lại magic bytes trên buffer đó (cho file
+    rất ngắn) và trả về chính nó (getvalue() không copy) thay vì đọc lại lần nữa.
+    """
+    if not file.filename.lower().endswith('.pdf'):
+        raise UploadError(f"Chỉ chấp nhận file PDF: {file.filename}")
+    if isinstance(file.stream, io.BytesIO):
+        pdf_data = file.stream.getvalue()
+        check_pdf_header(pdf_data[:PDF_MAGIC_SEARCH_BYTES])
+        return pdf_data
+    return read_pdf_stream(file.stream, max_bytes)
+
+def request_mode() -> str:
+    """Chế độ phân tích từ query string (body PDF thô) hoặc form multipart; ném UploadError nếu không hợp lệ"""
+    mode = request.args.get('mode', 'summarize')
+    if request.mimetype != 'application/pdf':
+        mode = request.form.get('mode', mode)
+    if mode not in ANALYSIS_MODES:
+        raise UploadError(f"Chế độ không hợp lệ: {mode}")
+    return mode
+
+def read_single_upload() -> tuple:
+    """Lấy (pdf_data, mode) từ body PDF thô hoặc form multipart; ném UploadError nếu không hợp lệ"""
+    max_bytes = current_app.config['MAX_CONTENT_LENGTH']
+    
+    if request.mimetype == 'application/pdf':
+        # Body là PDF thô: đọc trực tiếp từ stream của request
+        mode = request_mode()
+        return read_pdf_stream(request.stream, max_bytes), mode
+    
+    if 'document' not in request.files:
+        raise UploadError("Không có file được upload")
+    
+    file = request.files['document']
+    if file.filename == '':
+        raise UploadError("Không có file được chọn")
+    
+    mode = request_mode()
+    pdf_data = read_upload_file(file, max_bytes)
+    file.close()
+    return pdf_data, mode
+
+@bp.route('/classify', methods=['POST'])
 def classify_document():
+    analyzer = get_services().analyzer
     try:
-        if 'document' not in request.files:
-            return jsonify({"error": "Không có file được upload"}), 400
+        pdf_data, mode = read_single_upload()
         
-        file = request.files['document']
-        if file.filename == '':
-            return jsonify({"error": "Không có file được chọn"}), 400
+        # Phân tích trực tiếp từ bộ nhớ, không ghi file tạm
+        result = analyzer.analyze_bytes(pdf_data, mode=mode)
+        status, headers = result_status(result)
+        return jsonify(result), status, headers
+    
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except HTTPException as e:
+        return jsonify({"error": e.description}), e.code
+    except Exception as e:
+        return jsonify({"error": f"Lỗi xử lý: {str(e)}"}), 500
+
+def result_status(result: Dict) -> tuple:
+    """(status, headers) HTTP cho kết quả phân tích: lỗi LLM không trả 200"""
+    status = ERROR_KIND_STATUS.get(result.get("error_kind"), 200)
+    headers = {}
+    if "retry_after" in result:
+        headers["Retry-After"] = str(max(1, math.ceil(result["retry_after"])))
+    return status, headers
+
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@bp.route('/classify/stream', methods=['POST'])
+def classify_document_stream():
+    """Như /classify nhưng trả về server-sent events: event "stage" sau mỗi bước, cuối cùng là event "result"
+
+    Header 200 đã gửi trước khi gọi LLM, nên lỗi LLM được báo bằng event cuối "error"
+    (thay cho "result") kèm "status" (429/503/502) và "retry_after" nếu bị từ chối do quá tải.
+    """
+    analyzer = get_services().analyzer
+    try:
+        pdf_data, mode = read_single_upload()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except HTTPException as e:
+        return jsonify({"error": e.description}), e.code
+    
+    events = queue.Queue()
+    timer = StageTimer(on_stage=lambda name, ms: events.put(("stage", {"stage": name, "ms": ms})))
+    
+    def run():
+        try:
+            events.put(("result", analyzer.analyze_bytes(pdf_data, mode=mode, timer=timer)))
+        except Exception as e:
+            events.put(("result", {"error": f"Lỗi xử lý: {str(e)}"}))
+    
+    def generate():
+        threading.Thread(target=run, name="classify-stream", daemon=True).start()
+        while True:
+            event, data = events.get()
+            if event == "result":
+                status, _ = result_status(data)
+                if status != 200:
+                    event, data = "error", dict(data, status=status)
+                yield _sse(event, data)
+                return
+            yield _sse(event, data)
+    
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@bp.route('/jobs', methods=['POST'])
+def create_jobs():
+    """Nhận một hoặc nhiều PDF, trả về job ID ngay lập tức"""
+    job_queue = get_services().job_queue
+    try:
+        max_bytes = current_app.config['MAX_CONTENT_LENGTH']
         
-        if file and file.filename.lower().endswith('.pdf'):
-            # Lưu file tạm
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                file.save(tmp_file.name)
-                
-                # Phân tích
-                result = analyzer.analyze_document(tmp_file.name)
-                
-                # Xóa file tạm
-                os.unlink(tmp_file.name)
-                
-                return jsonify(result)
+        if request.mimetype == 'application/pdf':
+            mode = request_mode()
+            filename = request.args.get('filename', 'document.pdf')
+            documents = [(filename, read_pdf_stream(request.stream, max_bytes), mode)]
         else:
-            return jsonify({"error": "Chỉ chấp nhận file PDF"}), 400
+            files = [f for f in request.files.getlist('document') if f.filename]
+            if not files:
+                return jsonify({"error": "Không có file được upload"}), 400
             
+            mode = request_mode()
+            documents = []
+            for file in files:
+                documents.append((secure_filename(file.filename), read_upload_file(file, max_bytes), mode))
+                file.close()
+        
+        job_ids = job_queue.submit_many(documents)
+        jobs = [{"id": job_id, "filename": doc[0], "status": "queued"} for job_id, doc in zip(job_ids, documents)]
+        return jsonify({"jobs": jobs}), 202
+    
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 429
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except HTTPException as e:
+        return jsonify({"error": e.description}), e.code
     except Exception as e:
         return jsonify({"error": f"Lỗi xử lý: {str(e)}"}), 500
 
-@app.route('/health')
+@bp.route('/jobs/<job_id>')
+def get_job(job_id):
+    job_queue = get_services().job_queue
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    if job["status"] == "failed" and job["result"]:
+        # Job thất bại vì llama-server quá tải/lỗi: trả cùng status như /classify
+        status, headers = result_status(job["result"])
+        return jsonify(job), status, headers
+    return jsonify(job)
+
+@bp.route('/jobs')
+def get_jobs():
+    """Trạng thái nhiều job: /jobs?ids=a,b,c"""
+    job_queue = get_services().job_queue
+    job_ids = [job_id for job_id in request.args.get('ids', '').split(',') if job_id]
+    if not job_ids:
+        return jsonify({"error": "Thiếu tham số ids"}), 400
+    jobs = job_queue.store.get_many(job_ids)
+    found = {job["id"] for job in jobs}
+    return jsonify({"jobs": jobs, "missing": [job_id for job_id in job_ids if job_id not in found]})
+
+@bp.route('/metrics')
+def metrics():
+    """Metric theo Prometheus text format
+
+    Chỉ gồm số liệu của process worker trả lời request (xem WORKERS trong config.py).
+    """
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@bp.route('/health')
 def health_check():
-    """Kiểm tra trạng thái llama-server"""
+    """Trạng thái llama-server lấy từ health check nền đã cache (không gọi HTTP mỗi lần probe)
+
+    Không tạo analyzer/hàng đợi job: worker chưa nhận request nào chỉ báo "starting",
+    để liveness probe không khởi động pool kết nối và thread.
+    """
+    analyzer, job_queue = get_services().existing()
+    if analyzer is None:
+        return jsonify({"status": "starting", "llama_server": None, "cache": None, "dedup": None,
+                        "ocr": None, "concurrency": None, "jobs": None})
+    cache_stats = analyzer.cache.stats() if analyzer.cache else None
+    dedup_stats = analyzer.dedup.stats() if analyzer.dedup else None
+    ocr_stats = analyzer.ocr.stats() if analyzer.ocr else None
+    limiter_stats = analyzer.limiter.stats() if analyzer.limiter else None
+    job_stats = job_queue.stats() if job_queue else None
+    llm = analyzer.qwen_client.health()
+    status = "healthy" if llm["available"] > 0 else "unhealthy"
+    return jsonify({"status": status, "llama_server": llm, "cache": cache_stats, "dedup": dedup_stats,
+                    "ocr": ocr_stats, "concurrency": limiter_stats, "jobs": job_stats})
+
+def serve(app: Flask, config: Dict):
+    """Chạy bằng gunicorn (WORKERS process x THREADS thread) nếu có, nếu không dùng server đa luồng của werkzeug"""
     try:
-        response = requests.get("http://localhost:8080/health", timeout=5)
-        if response.status_code == 200:
-            return jsonify({"status": "healthy", "llama_server": "running"})
-        else:
-            return jsonify({"status": "unhealthy", "llama_server": "error"})
-    except:
-        return jsonify({"status": "unhealthy", "llama_server": "offline"})
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import run_simple
+
+        logging.warning("gunicorn not installed, falling back to single-process threaded werkzeug server")
+        run_simple(config["HOST"], config["PORT"], app, threaded=True)
+        return
+
+    if config["WORKERS"] > 1:
+        logging.warning(f"WORKERS={config['WORKERS']}: /metrics only reports the worker that answers each scrape")
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{config['HOST']}:{config['PORT']}")
+            self.cfg.set("workers", config["WORKERS"])
+            self.cfg.set("threads", config["THREADS"])
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("timeout", config["TIMEOUT"])
+
+        def load(self):
+            return app
+
+    Application().run()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    config = load_config()
+    serve(create_app(config), config)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from metrics import REGISTRY
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+LLM_REQUESTS_TOTAL = REGISTRY.counter(
+    "llm_requests_total", "Số lần gửi request tới từng llama-server", ["backend", "status"])
+
+class LLMError(Exception):
+    """Không nhận được response hợp lệ từ llama-server (sau khi đã retry)"""
+
+class LLMServerError(LLMError):
+    """llama-server quá tải hoặc lỗi tạm thời: timeout, lỗi kết nối, HTTP 429/5xx (đã hết lượt retry)"""
+
+class LLMUnavailableError(LLMError):
+    """Không còn llama-server nào nhận request (circuit breaker mở / health check lỗi)"""
+
+class CircuitBreaker:
+    """Ngừng gửi request tới backend sau `failure_threshold` lỗi liên tiếp
+
+    closed -> open khi lỗi liên tiếp đủ ngưỡng; sau `reset_timeout` giây chuyển
+    half_open và cho đúng một request thử: thành công thì closed, lỗi thì open lại.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning(f"Circuit breaker open after {self.failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+class Backend:
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        self.url = url.rstrip("/")
+        self.breaker = breaker
+        self.in_flight = 0
+        # Kết quả health check gần nhất (None: chưa kiểm tra)
+        self.health: Optional[Dict] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.health is None or self.health["status"] == "ok"
+
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "in_flight": self.in_flight,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "health": self.health
+        }
+
+class BackendPool:
+    """Danh sách llama-server, chọn backend đang ít request nhất (least in-flight)
+
+    Backend có circuit breaker đang mở hoặc health check lỗi bị bỏ qua; nếu mọi
+    backend đều báo lỗi health thì vẫn thử những backend breaker còn cho phép,
+    vì kết quả health check có thể đã cũ.
+    Health check chạy trong thread nền mỗi `health_interval` giây (0: tắt),
+    kết quả được cache để /health đọc ngay không phải gọi HTTP.
+    """
+
+    def __init__(self, urls: List[str], failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 health_interval: float = 10.0, health_timeout: float = 2.0):
+        if not urls:
+            raise ValueError("Cần ít nhất một URL llama-server")
+        self.backends = [Backend(url, CircuitBreaker(failure_threshold, reset_timeout)) for url in urls]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_interval > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, name="llm-health", daemon=True)
+            self._health_thread.start()
+
+    def acquire(self) -> Backend:
+        with self._lock:
+            # Xoay vòng điểm bắt đầu để các backend cùng in_flight được chia đều
+            order = self.backends[self._next:] + self.backends[:self._next]
+            self._next = (self._next + 1) % len(self.backends)
+            order.sort(key=lambda backend: (not backend.healthy, backend.in_flight))
+            for backend in order:
+                if backend.breaker.allow():
+                    backend.in_flight += 1
+                    return backend
+        LLM_REQUESTS_TOTAL.inc(backend="none", status="unavailable")
+        raise LLMUnavailableError("Không có llama-server khả dụng (circuit breaker đang mở)")
+
+    def release(self, backend: Backend, success: bool):
+        with self._lock:
+            backend.in_flight -= 1
+        if success:
+            backend.breaker.record_success()
+        else:
+            backend.breaker.record_failure()
+
+    def check_health(self):
+        """Gọi /health của từng backend và lưu kết quả"""
+        for backend in self.backends:
+            start = time.perf_counter()
+            try:
+                response = requests.get(f"{backend.url}/health", timeout=self.health_timeout)
+                status = "ok" if response.status_code == 200 else "error"
+            except requests.RequestException:
+                status = "offline"
+            backend.health = {
+                "status": status,
+                "latency_ms": (time.perf_counter() - start) * 1000,
+                "checked_at": time.time()
+            }
+
+    def _health_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.check_health()
+            except Exception as e:
+                logging.error(f"Error checking llama-server health: {e}")
+            self._stop.wait(self.health_interval)
+
+    def close(self):
+        """Dừng thread health check (chờ tối đa một lần kiểm tra đang chạy)"""
+        self._stop.set()
+        if self._health_thread is not None and self._health_thread is not threading.current_thread():
+            self._health_thread.join(timeout=self.health_timeout + 1.0)
+
+    def stats(self) -> Dict:
+        backends = [backend.stats() for backend in self.backends]
+        available = sum(1 for backend in self.backends if backend.healthy and backend.breaker.state != "open")
+        return {"available": available, "total": len(backends), "backends": backends}
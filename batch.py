@@ -0,0 +1,256 @@
+from processor import DocumentProcessor
+from cache import hash_bytes
+from ingest import PdfSource, PrefetchReader, iter_pdf_sources
+from metrics import StageTimer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, Set, Union
+import argparse
+import json
+import logging
+import os
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Processor dùng riêng trong mỗi process trích xuất (không cần client LLM)
+_worker_processor = None
+_worker_hash_files = False
+
+def _init_extract_worker(hash_files: bool = False):
+    global _worker_processor, _worker_hash_files
+    _worker_processor = DocumentProcessor(None)
+    _worker_hash_files = hash_files
+
+def _extract_worker(source: PdfSource) -> tuple:
+    """Trích xuất trang đầu (và hash nội dung cho cache) trong process con
+
+    Nội dung được đưa thẳng vào PyMuPDF qua stream (mmap hoặc bytes của thành viên archive),
+    không giải nén ra file tạm.
+    """
+    timer = StageTimer()
+    try:
+        with source.buffer() as data:
+            text = _worker_processor.extract_first_page_from_bytes(data, timer)
+            pdf_hash = hash_bytes(data) if _worker_hash_files and text else None
+    except Exception as e:
+        logging.error(f"Error reading {source.name}: {e}")
+        text, pdf_hash = "", None
+    return source, text, pdf_hash, timer
+
+def _source_hash(source: PdfSource) -> str:
+    with source.buffer() as data:
+        return hash_bytes(data)
+
+def _analyze_extracted(analyzer, pdf_path: str, first_page_text: str, pdf_hash: str = None,
+                       mode: str = "summarize", timer: StageTimer = None, used_ocr: bool = False) -> Dict:
+    """Chạy các bước LLM cho một tài liệu đã trích xuất"""
+    try:
+        result = analyzer.analyze_text(first_page_text, show_progress=False, pdf_hash=pdf_hash, mode=mode,
+                                       timer=timer)
+    except Exception as e:
+        logging.error(f"Error analyzing {pdf_path}: {e}")
+        result = {
+            "error": f"Lỗi xử lý: {str(e)}",
+            "category": "Lỗi",
+            "confidence": 0.0
+        }
+    result["file"] = pdf_path
+    if used_ocr:
+        result["text_source"] = "ocr"
+    return result
+
+def run_pipeline(analyzer, pdf_paths: Iterable[Union[str, PdfSource]], extract_workers: int = None,
+                 max_in_flight: int = 4, mode: str = "summarize") -> Iterator[Dict]:
+    """Pipeline trích xuất (process pool) -> [OCR] -> LLM (tối đa max_in_flight tài liệu)
+
+    Số tài liệu đã/đang trích xuất nhưng chưa vào bước LLM được giới hạn,
+    nên bộ nhớ không tăng theo kích thước thư mục đầu vào.
+    PDF không có lớp text được chuyển sang pool OCR riêng của analyzer (nếu bật),
+    các tài liệu có text vẫn đi thẳng vào bước LLM không phải chờ.
+    Đầu vào là đường dẫn PDF hoặc PdfSource (thành viên archive); một thread đọc
+    trước liệt kê/đọc nguồn song song với trích xuất để process pool luôn có việc.
+    """
+    extract_workers = extract_workers or os.cpu_count() or 1
+    prefetch = extract_workers + max_in_flight
+    reader = PrefetchReader((PdfSource("file", item, path=item) if isinstance(item, str) else item
+                             for item in pdf_paths), max_prefetch=prefetch)
+    paths = iter(reader)
+
+    extract_pending = set()
+    llm_pending = set()
+    extracted = deque()
+    ocr = analyzer.ocr if analyzer.ocr is not None and analyzer.ocr.available else None
+    ocr_pending = {}
+
+    with ProcessPoolExecutor(max_workers=extract_workers, initializer=_init_extract_worker,
+                             initargs=(analyzer.cache is not None,)) as extract_pool, \
+            ThreadPoolExecutor(max_workers=max_in_flight) as llm_pool, closing(reader):
+
+        def refill():
+            while len(extract_pending) + len(ocr_pending) + len(extracted) < prefetch:
+                source = next(paths, None)
+                if source is None:
+                    return
+                extract_pending.add(extract_pool.submit(_extract_worker, source))
+
+        refill()
+        while extract_pending or ocr_pending or extracted or llm_pending:
+            while extracted and len(llm_pending) < max_in_flight:
+                source, text, pdf_hash, timer, used_ocr = extracted.popleft()
+                llm_pending.add(llm_pool.submit(_analyze_extracted, analyzer, source.name, text, pdf_hash, mode, timer,
+                                                used_ocr))
+
+            # OCR treo không được chặn cả pipeline: chờ tối đa tới hạn của tài liệu OCR lâu nhất
+            timeout = None
+            if ocr_pending:
+                oldest = min(submitted for _, _, submitted in ocr_pending.values())
+                timeout = max(0.0, oldest + ocr.result_timeout - time.perf_counter())
+            done, _ = wait(extract_pending | llm_pending | ocr_pending.keys(), timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                done = {future for future, (_, _, submitted) in ocr_pending.items()
+                        if time.perf_counter() - submitted >= ocr.result_timeout}
+            for future in done:
+                if future in extract_pending:
+                    extract_pending.remove(future)
+                    source, text, pdf_hash, timer = future.result()
+                    if not text and ocr is not None:
+                        ocr_pending[ocr.submit(source)] = (source, timer, time.perf_counter())
+                    else:
+                        extracted.append((source, text, pdf_hash, timer, False))
+                elif future in ocr_pending:
+                    source, timer, submitted = ocr_pending.pop(future)
+                    text = ocr.result(future, timeout=0 if not future.done() else None)
+                    timer.timings["ocr_ms"] = (time.perf_counter() - submitted) * 1000
+                    pdf_hash = _source_hash(source) if analyzer.cache is not None and text else None
+                    extracted.append((source, text, pdf_hash, timer, True))
+                else:
+                    llm_pending.remove(future)
+                    yield future.result()
+            refill()
+
+def load_completed(output_path: str) -> Set[str]:
+    """Đọc file JSONL kết quả, trả về các file đã xử lý thành công"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Dòng cuối có thể bị cắt nếu lần chạy trước bị dừng giữa chừng
+                continue
+            if "file" in record and "error" not in record:
+                completed.add(record["file"])
+    return completed
+
+def run_batch(analyzer, inputs: Iterable[str], output_path: str, extract_workers: int = None,
+              max_in_flight: int = 4, mode: str = "summarize") -> Dict:
+    """Phân loại hàng loạt, ghi JSONL ngay khi từng tài liệu hoàn thành
+
+    Các file đã có kết quả thành công trong output_path sẽ được bỏ qua,
+    nên chạy lại sẽ tiếp tục từ chỗ đã dừng.
+    """
+    completed = load_completed(output_path)
+    stats = {"processed": 0, "errors": 0, "skipped": 0, "prefilter": 0, "near_duplicate": 0, "ocr": 0}
+
+    def pending_paths():
+        for source in iter_pdf_sources(inputs):
+            if source.name in completed:
+                stats["skipped"] += 1
+                continue
+            yield source
+
+    with open(output_path, 'a', encoding='utf-8') as out:
+        for result in run_pipeline(analyzer, pending_paths(), extract_workers=extract_workers,
+                                   max_in_flight=max_in_flight, mode=mode):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+
+            stats["processed"] += 1
+            if "error" in result:
+                stats["errors"] += 1
+            if result.get("engine") in ("prefilter", "near_duplicate"):
+                stats[result["engine"]] += 1
+            if result.get("text_source") == "ocr":
+                stats["ocr"] += 1
+            logging.info(f"{result['file']}: {result.get('category')} ({result.get('confidence', 0.0):.2f})")
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Phân loại hàng loạt văn bản PDF")
+    parser.add_argument("inputs", nargs="+", help="File PDF, archive ZIP/TAR chứa PDF hoặc thư mục")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="File JSONL kết quả")
+    parser.add_argument("--url", nargs="+", default=["http://localhost:8080"],
+                        help="Địa chỉ llama-server (nhiều địa chỉ: chia tải theo số request đang chạy)")
+    parser.add_argument("--extract-workers", type=int, default=None,
+                        help="Số process trích xuất PDF (mặc định: số CPU)")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="Số tài liệu gọi LLM đồng thời")
+    parser.add_argument("--mode", choices=["summarize", "direct", "constrained"], default="summarize",
+                        help="summarize: tóm tắt rồi phân loại; direct: phân loại trực tiếp (1 lần gọi LLM); "
+                             "constrained: 1 token nhãn, độ tin cậy từ xác suất token")
+    parser.add_argument("--prefilter", default=None,
+                        help="Model phân loại cục bộ (prefilter.py); tài liệu chắc chắn không cần gọi LLM")
+    parser.add_argument("--prefilter-threshold", type=float, default=0.9,
+                        help="Ngưỡng xác suất để dùng kết quả phân loại cục bộ")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="Gom tối đa N prompt vào một request llama-server (0: tắt)")
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0,
+                        help="Thời gian tối đa chờ gom batch")
+    parser.add_argument("--slots", type=int, default=4,
+                        help="Số request llama-server song song khi gom batch (nên bằng -np của server)")
+    parser.add_argument("--pin-slots", action="store_true",
+                        help="Ghim request vào một trong --slots slot của server để tái dùng KV cache của prefix")
+    parser.add_argument("--early-stop", action="store_true",
+                        help="Stream phản hồi phân loại và dừng ngay khi đã có nhãn + độ tin cậy")
+    parser.add_argument("--cache", default="result_cache.db",
+                        help="File cache kết quả LLM (để trống để tắt)")
+    parser.add_argument("--dedup", default="dedup_index.db",
+                        help="Chỉ mục tài liệu gần trùng (SimHash) để dùng lại kết quả (để trống để tắt)")
+    parser.add_argument("--dedup-max-distance", type=int, default=3,
+                        help="Khoảng cách Hamming tối đa (0-3) giữa SimHash 64 bit để coi là gần trùng")
+    parser.add_argument("--ocr-workers", type=int, default=0,
+                        help="Số process OCR (Tesseract) cho PDF không có lớp text (0: tắt)")
+    parser.add_argument("--ocr-dpi", type=int, default=200, help="Độ phân giải render trang để OCR")
+    parser.add_argument("--ocr-lang", default="vie", help="Ngôn ngữ Tesseract (ví dụ vie, vie+eng)")
+    parser.add_argument("--ocr-timeout", type=float, default=30.0, help="Giới hạn thời gian OCR mỗi tài liệu (giây)")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="Tự điều chỉnh số request LLM đồng thời theo thời gian chờ ở server "
+                             "(có thể đặt --max-in-flight cao, giới hạn thực tế do bộ điều khiển quyết định)")
+    parser.add_argument("--target-queue-ms", type=float, default=100.0,
+                        help="Thời gian chờ slot server tối đa trước khi giảm số request đồng thời")
+    parser.add_argument("--taxonomy", default=None,
+                        help="File JSON cây loại tài liệu (mặc định: Thông báo / Tài chính)")
+    args = parser.parse_args()
+
+    from main import DocumentAnalyzer
+
+    analyzer = DocumentAnalyzer(args.url, cache_path=args.cache or None, prefilter_path=args.prefilter,
+                                prefilter_threshold=args.prefilter_threshold, batch_max_size=args.batch_size,
+                                batch_max_wait_ms=args.batch_wait_ms, batch_slots=args.slots,
+                                llm_slots=args.slots if args.pin_slots else 0, early_stop=args.early_stop,
+                                dedup_path=args.dedup or None, dedup_max_distance=args.dedup_max_distance,
+                                taxonomy_path=args.taxonomy, ocr_workers=args.ocr_workers,
+                                ocr_options={"dpi": args.ocr_dpi, "lang": args.ocr_lang, "timeout": args.ocr_timeout},
+                                adaptive_concurrency=args.adaptive_concurrency,
+                                # Chạy batch không bỏ tài liệu: chờ lượt thay vì từ chối khi quá tải
+                                limiter_options={"initial_limit": args.slots, "target_queue_ms": args.target_queue_ms,
+                                                 "queue_timeout": None})
+    stats = run_batch(analyzer, args.inputs, args.output, extract_workers=args.extract_workers,
+                      max_in_flight=args.max_in_flight, mode=args.mode)
+    if analyzer.cache:
+        stats["cache"] = analyzer.cache.stats()
+    if analyzer.dedup:
+        stats["dedup"] = analyzer.dedup.stats()
+    if analyzer.limiter:
+        stats["concurrency"] = analyzer.limiter.stats()
+    print(json.dumps(stats, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Union
+
+import fitz
+
+from prefilter import load_data_txt
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Hồ sơ hiệu năng giả lập của llama-server
+PROFILES = {
+    "instant": {"base_latency_ms": 0, "prompt_tokens_per_s": 1e9, "tokens_per_s": 1e9, "slots": 64},
+    "gpu": {"base_latency_ms": 5, "prompt_tokens_per_s": 4000, "tokens_per_s": 80, "slots": 4},
+    "cpu": {"base_latency_ms": 20, "prompt_tokens_per_s": 300, "tokens_per_s": 15, "slots": 2},
+}
+
+# Font Unicode có đủ dấu tiếng Việt (font base14 "helv" biến chữ có dấu thành "?")
+PDF_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/noto/NotoSans-Regular.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+]
+
+FINANCE_KEYWORDS = ["tỷ", "thuế", "đầu tư", "ngân hàng", "lạm phát", "ngân sách", "bảo hiểm", "vay", "lợi nhuận sau"]
+
+# Dòng "- Nhóm 0: ..." / "- Loại 1: ..." cấp đầu trong danh sách loại của prompt
+_TOP_LEVEL_CHOICE = re.compile(r"^- (?:Nhóm|Loại) (\d+): (.+)$", re.M)
+
+def _grammar_code(grammar: str, first: str) -> str:
+    """Mã hợp lệ theo grammar GBNF của taxonomy: chọn `first` ở cấp đầu (nếu có), rồi nút con đầu tiên mỗi cấp"""
+    rules = {}
+    for line in grammar.splitlines():
+        name, _, body = line.partition("::=")
+        rules[name.strip()] = [alternative.split() for alternative in body.split("|")]
+    code, rule = [], "root"
+    while rule:
+        alternatives = rules[rule]
+        alternative = next((a for a in alternatives if a[0].strip('"') == first), alternatives[0])
+        code += [token.strip('"') for token in alternative if token.startswith('"')]
+        rule = next((token for token in alternative if not token.startswith('"')), None)
+        first = None
+    return "".join(code)
+
+def _estimate_tokens(text: str) -> int:
+    # Ước lượng thô cho tiếng Việt: ~3 ký tự / token
+    return max(1, len(text) // 3)
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Header và body được ghi riêng; tắt Nagle để không bị trễ ~40ms do delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: Dict, status: int = 200):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, payload: Dict):
+        # Server-sent events qua chunked transfer encoding như llama-server: mỗi event là một
+        # HTTP chunk được flush ngay, nên client nhận token khi vừa sinh (không chờ đầy bộ đệm đọc)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_chunk(data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def send_chunk(chunk: Dict):
+            write_chunk(b"data: " + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b"\n\n")
+
+        try:
+            self.server.mock.stream(payload, send_chunk)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client đóng stream sớm: dừng sinh, trả slot
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json({"status": "ok"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if self.path != "/completion":
+            self._send_json({"error": "not found"}, 404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length))
+        if random.random() < self.server.mock.config.get("fail_rate", 0.0):
+            self._send_json({"error": "simulated overload"}, 503)
+            return
+        if isinstance(payload.get("prompt"), list):
+            self._send_json(self.server.mock.complete_many(payload))
+        elif payload.get("stream"):
+            self._send_events(payload)
+        else:
+            self._send_json(self.server.mock.complete(payload))
+
+class _SlotPool:
+    """Slot song song của server giả lập; lấy nhiều slot một lúc theo kiểu all-or-none
+
+    Request multi-prompt chỉ chạy khi đủ slot cho cả đợt, không giữ một phần
+    slot trong lúc chờ phần còn lại (tránh deadlock giữa các request đồng thời).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._free = size
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int = 1):
+        n = min(n, self.size)
+        with self._cond:
+            self._cond.wait_for(lambda: self._free >= n)
+            self._free -= n
+        return n
+
+    def release(self, n: int = 1):
+        with self._cond:
+            self._free += n
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, n: int = 1):
+        n = self.acquire(n)
+        try:
+            yield
+        finally:
+            self.release(n)
+
+class MockLlamaServer:
+    """llama-server giả lập (/completion, /health) với độ trễ và tốc độ token cấu hình được
+
+    Số slot song song được mô phỏng bằng _SlotPool, nên khi quá tải
+    request phải xếp hàng giống server thật. Mỗi slot nhớ prompt gần nhất;
+    với cache_prompt, phần prefix trùng được coi là đã có KV cache và không
+    tính thời gian prompt eval.
+    """
+
+    def __init__(self, profile: str = "gpu", host: str = "127.0.0.1", port: int = 0, **overrides):
+        self.config = dict(PROFILES[profile], **overrides)
+        self._slots = _SlotPool(self.config["slots"])
+        self._slot_prompts = [""] * self.config["slots"]
+        self._cache_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockLlamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _respond(self, payload: Dict) -> str:
+        prompt = payload.get("prompt", "")
+        # Chỉ xét phần văn bản: danh sách loại của taxonomy cũng có thể chứa từ khóa tài chính
+        document = re.split(r"Văn bản:|Nội dung cần phân loại:", prompt)[-1]
+        is_finance = any(keyword in document.lower() for keyword in FINANCE_KEYWORDS)
+        label = "1" if is_finance else "0"
+
+        if "grammar" in payload:
+            # Nhóm/loại cấp đầu có tên chứa "tài chính" cho văn bản tài chính, nhóm khác cho phần còn lại
+            choices = _TOP_LEVEL_CHOICE.findall(prompt)
+            finance = [code for code, name in choices if "tài chính" in name.lower()]
+            other = [code for code, name in choices if code not in finance]
+            first = (finance if is_finance else other) or [label]
+            return _grammar_code(payload["grammar"], first[0])
+        if "json_schema" in payload:
+            return label
+        if "Hãy tóm tắt" in prompt:
+            # Giữ lại phần đầu văn bản để bước phân loại vẫn thấy từ khóa
+            text = prompt.split("Văn bản:", 1)[-1].strip()
+            return text[:200]
+        return f"Loại: {label}\nĐộ tin cậy: 0.9\nLý do: Phản hồi giả lập\nTóm tắt: Văn bản giả lập"
+
+    def _cached_prefix_tokens(self, payload: Dict) -> int:
+        """Số token prefix đã có trong KV cache của slot xử lý prompt này"""
+        prompt = payload.get("prompt", "")
+        with self._cache_lock:
+            slot = payload.get("id_slot", -1)
+            if not 0 <= slot < len(self._slot_prompts):
+                # Không ghim slot: server chọn slot có prefix chung dài nhất
+                slot = max(range(len(self._slot_prompts)),
+                           key=lambda i: len(os.path.commonprefix([prompt, self._slot_prompts[i]])))
+            common = len(os.path.commonprefix([prompt, self._slot_prompts[slot]]))
+            self._slot_prompts[slot] = prompt
+        if not payload.get("cache_prompt") or not common:
+            return 0
+        # Ít nhất một token cuối luôn phải eval lại
+        return min(common // 3, _estimate_tokens(prompt) - 1)
+
+    def complete(self, payload: Dict, hold_slot: bool = True) -> Dict:
+        content = self._respond(payload)
+        total_n = _estimate_tokens(payload.get("prompt", ""))
+        cached_n = self._cached_prefix_tokens(payload)
+        prompt_n = total_n - cached_n
+        predicted_n = min(payload.get("n_predict", 512), _estimate_tokens(content))
+        prompt_ms = prompt_n / self.config["prompt_tokens_per_s"] * 1000
+        predicted_ms = predicted_n / self.config["tokens_per_s"] * 1000
+
+        if hold_slot:
+            with self._slots.hold():
+                time.sleep((self.config["base_latency_ms"] + prompt_ms + predicted_ms) / 1000)
+
+        if "grammar" in payload:
+            # Mã loại sinh từng ký tự: mỗi cấp một token chữ số, ngăn cách bởi dấu chấm
+            tokens = list(content)
+        else:
+            tokens = [content]
+        completion_probabilities = [
+            {"content": token, "probs": [{"tok_str": token, "prob": 0.9},
+                                         {"tok_str": "1" if token == "0" else "0", "prob": 0.1}]}
+            for token in tokens
+        ]
+        return {
+            "content": content,
+            "stop": True,
+            "tokens_evaluated": total_n,
+            "tokens_predicted": predicted_n,
+            "tokens_cached": cached_n,
+            "timings": {
+                "prompt_n": prompt_n,
+                "prompt_ms": prompt_ms,
+                "predicted_n": predicted_n,
+                "predicted_ms": predicted_ms
+            },
+            "completion_probabilities": completion_probabilities
+        }
+
+    def stream(self, payload: Dict, send_chunk):
+        """Stream: giữ slot khi eval prompt rồi gửi từng token; send_chunk lỗi khi client ngắt kết nối"""
+        result = self.complete(payload, hold_slot=False)
+        content = result.pop("content")
+        result.pop("completion_probabilities")
+        predicted_n = result["tokens_predicted"]
+        pieces = [content[i * 3:(i + 1) * 3] for i in range(predicted_n - 1)] + [content[(predicted_n - 1) * 3:]]
+        with self._slots.hold():
+            time.sleep((self.config["base_latency_ms"] + result["timings"]["prompt_ms"]) / 1000)
+            for piece in pieces:
+                time.sleep(result["timings"]["predicted_ms"] / predicted_n / 1000)
+                send_chunk({"content": piece, "stop": False})
+            send_chunk(dict(result, content="", stop=True))
+
+    def complete_many(self, payload: Dict) -> List[Dict]:
+        """Multi-prompt: các prompt chạy song song trên các slot, theo từng đợt `slots` prompt"""
+        prompts = payload["prompt"]
+        results = [self.complete(dict(payload, prompt=prompt), hold_slot=False) for prompt in prompts]
+        for i, result in enumerate(results):
+            result["index"] = i
+
+        wave = self.config["slots"]
+        for start in range(0, len(results), wave):
+            chunk = results[start:start + wave]
+            with self._slots.hold(len(chunk)):
+                longest = max(r["timings"]["prompt_ms"] + r["timings"]["predicted_ms"] for r in chunk)
+                time.sleep((self.config["base_latency_ms"] + longest) / 1000)
+        return results
+
+def find_pdf_font() -> str:
+    """Đường dẫn font TTF tiếng Việt (biến môi trường BENCHMARK_FONT hoặc font hệ thống thường gặp)"""
+    for path in [os.getenv("BENCHMARK_FONT", "")] + PDF_FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    raise FileNotFoundError("Không tìm thấy font Unicode có dấu tiếng Việt; đặt BENCHMARK_FONT=<file .ttf>")
+
+def make_pdf(text: str, fontfile: str = None) -> bytes:
+    """Tạo PDF một trang chứa đoạn văn bản (nhúng subset font Unicode để giữ dấu tiếng Việt)"""
+    with fitz.open() as doc:
+        page = doc.new_page()
+        page.insert_font(fontname="vn", fontfile=fontfile or find_pdf_font())
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontname="vn", fontsize=11)
+        doc.subset_fonts()
+        return doc.tobytes(garbage=3, deflate=True)
+
+def _normalize_space(text: str) -> str:
+    return " ".join(text.split())
+
+def check_roundtrip(pdf_data: bytes, text: str):
+    """Text trích xuất từ PDF sinh ra phải khớp văn bản gốc, nếu không kết quả benchmark vô nghĩa"""
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        extracted = doc.load_page(0).get_text()
+    if _normalize_space(extracted) != _normalize_space(text):
+        raise ValueError(f"PDF giả lập không giữ nguyên văn bản: {_normalize_space(extracted)[:80]!r} "
+                         f"!= {_normalize_space(text)[:80]!r}")
+
+def make_corpus(data_path: str, n_docs: int) -> List[tuple]:
+    """Sinh n_docs PDF (bytes, label) lặp lại từ data.txt"""
+    texts, labels = load_data_txt(data_path)
+    fontfile = find_pdf_font()
+    pdfs = [make_pdf(text, fontfile) for text in texts]
+    for pdf_data, text in zip(pdfs, texts):
+        check_roundtrip(pdf_data, text)
+    return [(pdfs[i % len(pdfs)], labels[i % len(pdfs)]) for i in range(n_docs)]
+
+def percentile(values: List[float], p: float) -> float:
+    """Percentile theo nearest-rank: phần tử thứ ceil(p/100 * n) của dãy đã sắp xếp"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize_latencies(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000
+    }
+
+# Gộp "timings" trong kết quả phân tích thành các bước cần báo cáo
+STAGE_TIMINGS = {
+    "extract": ("pdf_open_ms", "page_extract_ms"),
+    "summarize": ("summarize_ms",),
+    "classify": ("classify_ms", "parse_ms"),
+}
+
+def _run_load(call, corpus: List[tuple], concurrency: int) -> Dict:
+    latencies = []
+    stage_times = {stage: [] for stage in STAGE_TIMINGS}
+    correct = 0
+    errors = 0
+    prompt_tokens = 0
+    cached_tokens = 0
+
+    def one(item):
+        pdf_data, label = item
+        start = time.perf_counter()
+        result = call(pdf_data)
+        return time.perf_counter() - start, result, label
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, result, label in pool.map(one, corpus):
+            latencies.append(latency)
+            timings = result.get("timings", {})
+            for stage, names in STAGE_TIMINGS.items():
+                if any(name in timings for name in names):
+                    stage_times[stage].append(sum(timings.get(name, 0.0) for name in names) / 1000)
+            for usage in result.get("llm_usage", {}).values():
+                prompt_tokens += usage.get("prompt_tokens", 0)
+                cached_tokens += usage.get("cached_tokens", 0)
+            if "error" in result:
+                errors += 1
+            elif result.get("category_id") == label:
+                correct += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "docs": len(corpus),
+        "elapsed_s": elapsed,
+        "docs_per_s": len(corpus) / elapsed if elapsed else 0.0,
+        "errors": errors,
+        "accuracy": correct / len(corpus) if corpus else 0.0,
+        "prompt_cache_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        "latency": summarize_latencies(latencies),
+        "stages": {stage: summarize_latencies(values) for stage, values in stage_times.items() if values}
+    }
+
+def bench_analyzer(server_url: Union[str, List[str]], corpus: List[tuple], concurrency: int, mode: str, **analyzer_options) -> Dict:
+    from main import DocumentAnalyzer
+
+    analyzer = DocumentAnalyzer(server_url, **analyzer_options)
+    run = _run_load(lambda pdf_data: analyzer.analyze_bytes(pdf_data, mode=mode), corpus, concurrency)
+    if analyzer.limiter:
+        run["concurrency_limit"] = analyzer.limiter.stats()["limit"]
+    return run
+
+def bench_app(server_url: Union[str, List[str]], corpus: List[tuple], concurrency: int, mode: str, **analyzer_options) -> Dict:
+    from app import create_app
+    from main import DocumentAnalyzer
+
+    client = create_app(analyzer=DocumentAnalyzer(server_url, **analyzer_options)).test_client()
+
+    def call(pdf_data):
+        response = client.post(f"/classify?mode={mode}", data=pdf_data, content_type="application/pdf")
+        return response.get_json()
+
+    return _run_load(call, corpus, concurrency)
+
+def compare(current: Dict, baseline: Dict) -> List[str]:
+    """So sánh docs/s và p95 với baseline theo từng target + concurrency"""
+    lines = []
+    base_runs = {(r["target"], r["concurrency"]): r for r in baseline.get("runs", [])}
+    for run in current["runs"]:
+        base = base_runs.get((run["target"], run["concurrency"]))
+        if base is None:
+            continue
+        throughput = (run["docs_per_s"] / base["docs_per_s"] - 1) * 100 if base["docs_per_s"] else 0.0
+        p95 = (run["latency"]["p95_ms"] / base["latency"]["p95_ms"] - 1) * 100 if base["latency"]["p95_ms"] else 0.0
+        lines.append(f"{run['target']:>8} c={run['concurrency']:<3} docs/s {throughput:+6.1f}%  p95 {p95:+6.1f}%")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DocumentAnalyzer / Flask app với llama-server giả lập")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="gpu")
+    parser.add_argument("--docs", type=int, default=100, help="Số tài liệu mỗi lượt chạy")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--target", choices=["analyzer", "app", "both"], default="analyzer")
+    parser.add_argument("--mode", choices=["summarize", "direct", "constrained"], default="summarize")
+    parser.add_argument("--data", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.txt"))
+    parser.add_argument("--batch-size", type=int, default=0, help="Gom prompt thành batch (0: tắt)")
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0)
+    parser.add_argument("--pin-slots", action="store_true", help="Ghim request vào slot (id_slot) theo prefix")
+    parser.add_argument("--early-stop", action="store_true", help="Stream và dừng sớm khi đã có nhãn")
+    parser.add_argument("--backends", type=int, default=1, help="Số llama-server giả lập (chia tải giữa các server)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ request bị trả 503 (kiểm tra retry)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Tự điều chỉnh số request LLM đồng thời theo thời gian chờ slot")
+    parser.add_argument("--save", help="Lưu kết quả JSON (baseline)")
+    parser.add_argument("--compare", help="So sánh với file baseline JSON")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.data, args.docs)
+    targets = ["analyzer", "app"] if args.target == "both" else [args.target]
+    report = {"profile": args.profile, "mode": args.mode, "docs": args.docs, "batch_size": args.batch_size,
+              "runs": []}
+    analyzer_options = {"batch_max_size": args.batch_size, "batch_max_wait_ms": args.batch_wait_ms,
+                        "llm_slots": PROFILES[args.profile]["slots"] if args.pin_slots else 0,
+                        "early_stop": args.early_stop, "adaptive_concurrency": args.adaptive}
+
+    with ExitStack() as stack:
+        servers = [stack.enter_context(MockLlamaServer(args.profile, fail_rate=args.fail_rate))
+                   for _ in range(args.backends)]
+        urls = [server.url for server in servers]
+        for target in targets:
+            bench = bench_analyzer if target == "analyzer" else bench_app
+            for concurrency in args.concurrency:
+                run = bench(urls, corpus, concurrency, args.mode, **analyzer_options)
+                run["target"] = target
+                report["runs"].append(run)
+
+                latency = run["latency"]
+                stages = "  ".join(f"{stage}={s['mean_ms']:.1f}ms" for stage, s in run["stages"].items())
+                print(f"{target:>8} c={concurrency:<3} {run['docs_per_s']:7.2f} docs/s  "
+                      f"p50={latency['p50_ms']:.1f}ms p95={latency['p95_ms']:.1f}ms p99={latency['p99_ms']:.1f}ms  "
+                      f"{stages}  cached={run['prompt_cache_ratio']:.0%} acc={run['accuracy']:.0%} "
+                      f"err={run['errors']}"
+                      + (f" limit={run['concurrency_limit']}" if "concurrency_limit" in run else ""))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print("\nSo với baseline:")
+        for line in compare(report, baseline):
+            print(line)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
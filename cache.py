@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+def hash_key(*parts) -> str:
+    """Tạo khóa SHA-256 từ các thành phần (str/bytes/None)"""
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            part = b""
+        elif isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+def hash_bytes(data: bytes) -> str:
+    """SHA-256 của dữ liệu trong bộ nhớ"""
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path: str) -> str:
+    """SHA-256 nội dung file"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+class ResultCache:
+    """Cache kết quả LLM trên đĩa (SQLite), giới hạn số bản ghi, loại bỏ theo LRU"""
+
+    def __init__(self, path: str = "result_cache.db", max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                value TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, stage: str, key: str) -> Optional[object]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE key = ? AND stage = ?", (key, stage)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return json.loads(row[0])
+
+    def set(self, stage: str, key: str, value: object):
+        with self._lock:
+            try:
+                exists = self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, stage, value, last_used) VALUES (?, ?, ?, ?)",
+                    (key, stage, json.dumps(value, ensure_ascii=False), time.time())
+                )
+                if not exists:
+                    self._size += 1
+                if self._size > self.max_entries:
+                    self._evict(self._size - self.max_entries)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing result cache: {e}")
+
+    def _evict(self, count: int):
+        self._conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)",
+            (count,)
+        )
+        self._size -= count
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._size,
+            "max_entries": self.max_entries
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,47 +1,262 @@
 from client import Qwen3Client
+from metrics import StageTimer
+from taxonomy import Taxonomy, TaxonomyNode
 import logging
-from typing import Dict
+from typing import Dict, List
 import json
+import math
 import os
+import re
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Đã nhận trọn dòng "Loại" và "Độ tin cậy" (kết thúc bằng xuống dòng): đủ để ra quyết định
+_LABEL_DECIDED = re.compile(r"Loại:\s*\d+[ \t]*\n.*?Độ tin cậy:\s*[\d.]+[ \t]*\n", re.S)
+EARLY_STOP_REASON = "Dừng sinh sớm sau khi có nhãn và độ tin cậy"
+
+def _fill_taxonomy(template: str, **parts) -> str:
+    """Điền phần phụ thuộc taxonomy vào template, giữ nguyên chỗ {text}/{summary_text} cho lúc phân loại"""
+    for name, value in parts.items():
+        template = template.replace("{" + name + "}", value.replace("{", "{{").replace("}", "}}"))
+    return template
+
 class DocumentClassifier:
-    def __init__(self, qwen_client: Qwen3Client):
-        self.qwen_client = qwen_client
-        self.categories = {
-            0: "Thông báo",
-            1: "Tài chính"
-        }
-    
-    def classify_document(self, summary_text: str) -> Dict:
-        """Phân loại văn bản dựa trên tóm tắt"""
-        
-        prompt = f"""Phân loại văn bản sau thuộc loại nào:
-- Loại 0: Thông báo (thông báo nội bộ, công văn, hướng dẫn, quy định)
-- Loại 1: Tài chính (báo cáo tài chính, bảng cân đối kế toán, báo cáo doanh thu, lợi nhuận)
+    # Danh sách loại (từ taxonomy) đặt đầu mọi prompt phân loại, văn bản đặt cuối,
+    # để llama-server tái sử dụng KV cache của phần prefix giữa các request (cache_prompt)
+    classification_prompt_template = """{instructions}Hãy trả lời theo format chính xác:
+Loại: [{choices}]
+Độ tin cậy: [số từ 0.0 đến 1.0]
+Lý do: [giải thích ngắn gọn]
 
 Nội dung cần phân loại:
 {summary_text}
 
-Hãy trả lời theo format chính xác:
-Loại: [0 hoặc 1]
+Trả lời:
+"""
+    classification_max_tokens = 150
+    classification_temperature = 0.0
+
+    # Chế độ direct: phân loại thẳng trên văn bản gốc, một lần gọi LLM
+    direct_prompt_template = """{instructions}Hãy trả lời theo format chính xác:
+Loại: [{choices}]
 Độ tin cậy: [số từ 0.0 đến 1.0]
-Lý do: [giải thích ngắn gọn]"""
+Lý do: [giải thích ngắn gọn]
+Tóm tắt: [1 câu tóm tắt nội dung chính]
+
+Văn bản:
+{text}
+
+Trả lời:
+"""
+    direct_max_tokens = 200
+    direct_max_input_chars = 2000
+
+    # Chế độ constrained: grammar chỉ cho phép sinh mã loại (1 chữ số mỗi cấp: nhóm rồi loại trong nhóm),
+    # độ tin cậy lấy từ xác suất token (n_probs) thay vì con số mô hình tự viết
+    constrained_prompt_template = """{instructions}{answer_instruction}
+
+Văn bản:
+{text}
+
+Loại:"""
+    constrained_n_probs = 10
 
-        response = self.qwen_client.generate_text(prompt, max_tokens=150, temperature=0.0)
+    def __init__(self, qwen_client: Qwen3Client, early_stop: bool = False, taxonomy: Taxonomy = None):
+        self.qwen_client = qwen_client
+        # early_stop: stream token và đóng stream ngay khi đã có nhãn + độ tin cậy,
+        # bỏ phần lý do/tóm tắt để rút ngắn thời gian và trả slot cho server sớm
+        self.early_stop = early_stop
+        self.taxonomy = taxonomy or Taxonomy.default()
+        self.categories = self.taxonomy.categories
+        
+        # Prompt được dựng một lần cho taxonomy; số loại chỉ làm dài phần prefix dùng chung (đã có KV cache)
+        self.classification_prompt = _fill_taxonomy(self.classification_prompt_template,
+                                                    instructions=self.taxonomy.leaf_instructions,
+                                                    choices=self.taxonomy.leaf_choices)
+        self.direct_prompt = _fill_taxonomy(self.direct_prompt_template,
+                                            instructions=self.taxonomy.leaf_instructions,
+                                            choices=self.taxonomy.leaf_choices)
+        self.constrained_prompt = _fill_taxonomy(self.constrained_prompt_template,
+                                                 instructions=self.taxonomy.code_instructions,
+                                                 answer_instruction=self.taxonomy.answer_instruction())
+    
+    def classify_document(self, summary_text: str, timer: StageTimer = None) -> Dict:
+        """Phân loại văn bản dựa trên tóm tắt"""
+        
+        prompt = self.classification_prompt.format(summary_text=summary_text)
+
+        timer = timer or StageTimer()
+        with timer.stage("classify"):
+            response = self.qwen_client.generate_text(prompt, max_tokens=self.classification_max_tokens,
+                                                      temperature=self.classification_temperature,
+                                                      stop_when=self._stop_when())
+        usage = self.qwen_client.last_usage
+        timer.record_llm("classify", usage)
         
         # Parse response
-        category, confidence, reason = self._parse_classification_response(response)
+        with timer.stage("parse"):
+            category, confidence, reason = self._parse_classification_response(response)
+            if usage.get("stopped_early") and reason == "Không có lý do":
+                reason = EARLY_STOP_REASON
         
         return {
             "category": self.categories.get(category, "Không xác định"),
             "category_id": category,
+            "category_path": self.taxonomy.path(category),
             "confidence": confidence,
             "reason": reason,
             "summary": summary_text
         }
     
+    def classify_direct(self, text: str, timer: StageTimer = None) -> Dict:
+        """Phân loại trực tiếp trên văn bản gốc, không qua bước tóm tắt"""
+        
+        if len(text) > self.direct_max_input_chars:
+            text = text[:self.direct_max_input_chars] + "..."
+        
+        prompt = self.direct_prompt.format(text=text)
+
+        timer = timer or StageTimer()
+        with timer.stage("classify"):
+            response = self.qwen_client.generate_text(prompt, max_tokens=self.direct_max_tokens,
+                                                      temperature=self.classification_temperature,
+                                                      stop_when=self._stop_when())
+        usage = self.qwen_client.last_usage
+        timer.record_llm("classify", usage)
+        
+        with timer.stage("parse"):
+            category, confidence, reason = self._parse_classification_response(response)
+            if usage.get("stopped_early") and reason == "Không có lý do":
+                reason = EARLY_STOP_REASON
+            summary = ""
+            for line in response.strip().split('\n'):
+                line = line.strip()
+                if line.startswith("Tóm tắt:"):
+                    summary = line.split(":", 1)[1].strip()
+        
+        return {
+            "category": self.categories.get(category, "Không xác định"),
+            "category_id": category,
+            "category_path": self.taxonomy.path(category),
+            "confidence": confidence,
+            "reason": reason,
+            "summary": summary
+        }
+    
+    def classify_constrained(self, text: str, timer: StageTimer = None) -> Dict:
+        """Phân loại bằng mã loại bị ràng buộc bởi grammar, một lần gọi LLM
+
+        Taxonomy nhiều cấp: grammar buộc sinh mã nhóm trước, rồi chỉ cho phép mã
+        loại thuộc nhóm vừa chọn, nên mỗi cấp chỉ tốn một token.
+        """
+        
+        if len(text) > self.direct_max_input_chars:
+            text = text[:self.direct_max_input_chars] + "..."
+        
+        prompt = self.constrained_prompt.format(text=text)
+
+        timer = timer or StageTimer()
+        with timer.stage("classify"):
+            result = self.qwen_client.complete(prompt, max_tokens=self.taxonomy.max_code_tokens, temperature=0.0,
+                                               grammar=self.taxonomy.grammar, n_probs=self.constrained_n_probs)
+        timer.record_llm("classify", self.qwen_client.last_usage)
+        leaf = self.taxonomy.leaf_for_code(result.get("content", "").strip())
+        if leaf is None:
+            return {
+                "error": "Không nhận được nhãn hợp lệ từ mô hình",
+                "category": "Lỗi",
+                "confidence": 0.0
+            }
+        
+        with timer.stage("parse"):
+            probabilities = self._path_probabilities(result.get("completion_probabilities", []))
+        if probabilities:
+            confidence = probabilities.get(leaf, 0.0)
+        else:
+            # Server không trả xác suất: chỉ biết nhãn được chọn
+            confidence = 0.5
+        
+        return {
+            "category": leaf.label,
+            "category_id": leaf.category_id,
+            "category_path": list(leaf.path),
+            "confidence": confidence,
+            "reason": "Xác suất token nhãn",
+            "label_probabilities": {node.label: p for node, p in probabilities.items()},
+            "summary": ""
+        }
+    
+    def _stop_when(self):
+        return self.label_decided if self.early_stop else None
+    
+    @staticmethod
+    def label_decided(text: str) -> bool:
+        """Phản hồi đang stream đã có đủ "Loại" và "Độ tin cậy" chưa"""
+        return _LABEL_DECIDED.search(text) is not None
+    
+    def _path_probabilities(self, completion_probabilities: List) -> Dict[TaxonomyNode, float]:
+        """Xác suất theo từng cấp của mã đã sinh, chuẩn hóa trên các nút con hợp lệ
+
+        Trả về phân phối trên các nút: nút con của nhóm đã chọn nhận xác suất
+        P(nhóm) * P(con | nhóm), các nhóm không được chọn giữ P(nhóm); độ tin cậy
+        của loại cuối cùng là tích xác suất dọc đường đi. Rỗng nếu thiếu xác suất.
+        """
+        distribution = {self.taxonomy.root: 1.0}
+        node = self.taxonomy.root
+        for entry in completion_probabilities:
+            if node.is_leaf:
+                break
+            chosen = str(entry.get("token", entry.get("content", ""))).strip()
+            if not chosen.isdigit():
+                continue  # dấu chấm giữa các cấp
+            
+            children = {child.code.rsplit(".", 1)[-1]: child for child in node.children}
+            level = {}
+            for token, prob in self._token_candidates(entry):
+                child = children.get(token.strip())
+                if child is not None:
+                    level[child] = level.get(child, 0.0) + prob
+            total = sum(level.values())
+            if total <= 0 or chosen not in children:
+                return {}
+            
+            parent_prob = distribution.pop(node)
+            for child, prob in level.items():
+                distribution[child] = parent_prob * prob / total
+            node = children[chosen]
+        return distribution if node.is_leaf else {}
+    
+    @staticmethod
+    def _token_candidates(entry: Dict) -> List[tuple]:
+        """Các token ứng viên (token, xác suất) tại một vị trí sinh
+
+        Hỗ trợ cả format cũ ("probs": [{"tok_str", "prob"}]) và mới
+        ("top_logprobs": [{"token", "logprob"}]) của llama-server.
+        """
+        if "top_logprobs" in entry:
+            return [(c.get("token", ""), math.exp(c.get("logprob", -math.inf))) for c in entry["top_logprobs"]]
+        return [(c.get("tok_str", ""), c.get("prob", 0.0)) for c in entry.get("probs", [])]
+    
+    def cache_signature(self) -> str:
+        """Định danh prompt + tham số phân loại, dùng làm một phần khóa cache"""
+        return json.dumps([self.classification_prompt, self.categories, self.classification_max_tokens,
+                           self.classification_temperature] + self._early_stop_signature(), ensure_ascii=False)
+    
+    def direct_cache_signature(self) -> str:
+        """Định danh prompt + tham số của chế độ direct"""
+        return json.dumps([self.direct_prompt, self.categories, self.direct_max_tokens,
+                           self.classification_temperature, self.direct_max_input_chars]
+                          + self._early_stop_signature(), ensure_ascii=False)
+    
+    def _early_stop_signature(self) -> List:
+        # Kết quả dừng sớm không có lý do/tóm tắt: tách khỏi cache của chế độ thường
+        return ["early_stop"] if self.early_stop else []
+    
+    def constrained_cache_signature(self) -> str:
+        """Định danh prompt + tham số của chế độ constrained"""
+        return json.dumps([self.constrained_prompt, self.categories, self.constrained_n_probs,
+                           self.direct_max_input_chars], ensure_ascii=False)
+    
     def _parse_classification_response(self, response: str) -> tuple:
         """Parse response từ Qwen3"""
         try:
@@ -1,38 +1,512 @@
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import contextvars
+import itertools
 import json
-from typing import Dict, List
+import random
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Union
 import logging
 
+from backends import LLM_REQUESTS_TOTAL, BackendPool, LLMError, LLMServerError
+
+# Usage của lần gọi gần nhất trong thread / asyncio task hiện tại
+_last_usage = contextvars.ContextVar("qwen3_last_usage", default={})
+
+def set_last_usage(usage: Dict):
+    """Ghi usage cho thread/task hiện tại (dùng khi request được gửi từ thread khác)"""
+    _last_usage.set(usage)
+
+def _usage_from_response(result: Dict, request_ms: float) -> Dict:
+    """Token và thời gian server báo cáo trong response /completion"""
+    timings = result.get("timings", {})
+    prompt_tokens = result.get("tokens_evaluated", timings.get("prompt_n", 0))
+    # prompt_n chỉ đếm token thực sự được tính lại; phần còn lại lấy từ prompt cache
+    evaluated_tokens = timings.get("prompt_n", prompt_tokens)
+    cached_tokens = result.get("tokens_cached", max(0, prompt_tokens - evaluated_tokens))
+    prompt_ms = timings.get("prompt_ms", 0.0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_eval_tokens": evaluated_tokens,
+        "cached_tokens": cached_tokens,
+        "predicted_tokens": result.get("tokens_predicted", timings.get("predicted_n", 0)),
+        "prompt_ms": prompt_ms,
+        # Ước lượng thời gian prompt eval tiết kiệm được nhờ cache, theo tốc độ eval thực tế
+        "prompt_ms_saved": cached_tokens * prompt_ms / evaluated_tokens if evaluated_tokens else 0.0,
+        "predicted_ms": timings.get("predicted_ms", 0.0),
+        "request_ms": request_ms
+    }
+
+def _is_retryable_status(status: int) -> bool:
+    # 429/503: server hết slot hoặc đang nạp model; 5xx khác: lỗi tạm thời
+    return status == 429 or status >= 500
+
+def _record_error(start: float, error: Exception):
+    _last_usage.set({"request_ms": (time.perf_counter() - start) * 1000, "error": str(error)})
+
+class _StreamReader:
+    """Ghép các event SSE của /completion (stream=True); dùng chung cho client sync và async"""
+
+    def __init__(self, start: float, stop_when: Callable[[str], bool] = None):
+        self.start = start
+        self.stop_when = stop_when
+        self.content = ""
+        self.final = {}
+        self.chunks = 0
+        self.first_token_ms = None
+        self.stopped_early = False
+
+    def feed(self, line: bytes) -> bool:
+        """Xử lý một dòng SSE; trả True khi nên dừng đọc (server báo stop hoặc stop_when thỏa)"""
+        line = line.strip()
+        if not line.startswith(b"data: ") or line == b"data: [DONE]":
+            return False
+        chunk = json.loads(line[6:])
+        self.content += chunk.get("content", "")
+        self.chunks += 1
+        if self.first_token_ms is None:
+            self.first_token_ms = (time.perf_counter() - self.start) * 1000
+        if chunk.get("stop"):
+            self.final = chunk
+            return True
+        if self.stop_when is not None and self.stop_when(self.content):
+            self.stopped_early = True
+            return True
+        return False
+
+    def result(self) -> Dict:
+        """Dict như complete() với "content" đã nhận và "stopped_early"; ghi usage cho thread/task hiện tại"""
+        request_ms = (time.perf_counter() - self.start) * 1000
+        # Dừng sớm thì không có chunk cuối chứa timings: chỉ biết số chunk đã nhận
+        usage = _usage_from_response(self.final, request_ms) if self.final else {"predicted_tokens": self.chunks,
+                                                                                 "request_ms": request_ms}
+        usage["first_token_ms"] = self.first_token_ms
+        usage["stopped_early"] = self.stopped_early
+        _last_usage.set(usage)
+        return dict(self.final, content=self.content, stopped_early=self.stopped_early)
+
 class Qwen3Client:
-    def __init__(self, base_url: str = "http://localhost:8080"):
-        self.base_url = base_url
+    """Client đồng bộ cho /completion của một hoặc nhiều llama-server
+
+    Request được gửi tới backend đang ít request nhất; lỗi timeout/kết nối/5xx
+    được retry (tối đa max_retries lần, backoff ngẫu nhiên) trên backend khác nếu có.
+    Hết lượt retry hoặc mọi backend đều bị circuit breaker chặn thì ném LLMError,
+    để lỗi hạ tầng không bị biến thành kết quả phân loại sai.
+    """
+
+    # Số ký tự đầu prompt dùng để nhận diện prefix cố định (template) khi ghim slot
+    prefix_key_chars = 64
+
+    def __init__(self, base_url: Union[str, List[str]] = "http://localhost:8080", pool_size: int = 10,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0, cache_prompt: bool = True,
+                 slots: int = 0, max_retries: int = 2, backoff_base: float = 0.2, backoff_max: float = 2.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0, health_interval: float = 10.0):
+        self.base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.base_url = self.base_urls[0]
+        self.backends = BackendPool(self.base_urls, failure_threshold=failure_threshold,
+                                    reset_timeout=reset_timeout, health_interval=health_interval)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
         self.headers = {"Content-Type": "application/json"}
-    
-    def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False) -> str:
-        """Gọi API của llama-server"""
-        
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_prompt = cache_prompt
+        # slots > 0: ghim request vào slot (id_slot) theo template + thread gọi,
+        # để cùng một prefix quay lại đúng slot đang giữ KV cache của nó
+        self.slots = slots
+        self._thread_index = threading.local()
+        self._thread_counter = itertools.count()
+
+        # Session giữ kết nối keep-alive, tái sử dụng giữa các request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=len(self.base_urls), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _build_payload(self, prompt: str, max_tokens: int, temperature: float, enable_thinking: bool) -> Dict:
         # Thêm instruction để disable thinking nếu cần
         if not enable_thinking:
             prompt = "/no_think\n" + prompt
-        
+
         payload = {
             "prompt": prompt,
             "n_predict": max_tokens,
             "temperature": temperature,
             "stop": ["</s>", "[/INST]"],
-            "stream": False
+            "stream": False,
+            "cache_prompt": self.cache_prompt
         }
-        
+        if self.slots > 0:
+            payload["id_slot"] = self._slot_for(prompt)
+        return payload
+
+    def _request_payload(self, prompt: str, max_tokens: int, temperature: float, enable_thinking: bool,
+                         options: Dict, stream: bool = False) -> Dict:
+        # options được gửi thẳng cho llama-server (grammar, json_schema, n_probs, ...)
+        payload = self._build_payload(prompt, max_tokens, temperature, enable_thinking)
+        payload.update(options)
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _many_payload(self, prompts: List[str], max_tokens: int, temperature: float, enable_thinking: bool,
+                      options: Dict) -> Dict:
+        payload = self._build_payload("", max_tokens, temperature, enable_thinking)
+        payload["prompt"] = [self._build_payload(prompt, max_tokens, temperature, enable_thinking)["prompt"]
+                             for prompt in prompts]
+        # Các prompt trong batch được server tự phân vào slot
+        payload.pop("id_slot", None)
+        payload.update(options)
+        return payload
+
+    @staticmethod
+    def _many_results(results: Union[Dict, List[Dict]], prompts: List[str], start: float) -> List[tuple]:
+        """Response multi-prompt -> list (response, usage) theo thứ tự prompts"""
+        if isinstance(results, dict):
+            results = [results]
+        if len(results) != len(prompts):
+            raise LLMError(f"Expected {len(prompts)} results, got {len(results)}")
+        results = sorted(results, key=lambda r: r.get("index", 0))
+        request_ms = (time.perf_counter() - start) * 1000
+        return [(result, _usage_from_response(result, request_ms)) for result in results]
+
+    def _slot_for(self, prompt: str) -> int:
+        """Slot cố định cho (template, thread): các thread khác nhau rải ra các slot khác nhau"""
+        index = getattr(self._thread_index, "value", None)
+        if index is None:
+            index = self._thread_index.value = next(self._thread_counter)
+        prefix = prompt[:self.prefix_key_chars].encode('utf-8')
+        return (zlib.crc32(prefix) + index) % self.slots
+
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter: ngẫu nhiên trong [0, base * 2^(attempt-1)], tối đa backoff_max"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    # Kế toán backend/metric dùng chung cho vòng retry của client sync và async
+
+    def _retry_failure(self, backend, error: Exception) -> Exception:
+        """Lỗi tạm thời (timeout/kết nối/429/5xx): tính lỗi cho backend, trả về lỗi để thử lại"""
+        self.backends.release(backend, success=False)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="retry")
+        return error
+
+    def _request_failure(self, backend, status: int, body: str) -> LLMError:
+        """Lỗi 4xx do request, backend vẫn khỏe: không retry"""
+        self.backends.release(backend, success=True)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="error")
+        return LLMError(f"{backend.url} trả về HTTP {status}: {body[:200]}")
+
+    def _retries_exhausted(self, last_error: Exception) -> LLMError:
+        return LLMServerError(f"Gọi llama-server thất bại sau {self.max_retries + 1} lần: {last_error}")
+
+    def _invalid_response(self, backend, error: Exception) -> LLMError:
+        self.backends.release(backend, success=False)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="error")
+        return LLMError(f"Response không hợp lệ từ {backend.url}: {error}")
+
+    def _succeeded(self, backend):
+        self.backends.release(backend, success=True)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="ok")
+
+    def _stream_failure(self, backend, start: float, error: Exception) -> LLMError:
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="error")
+        logging.error(f"Error reading Qwen3 stream: {error}")
+        _record_error(start, error)
+        # Dữ liệu stream không hợp lệ là lỗi response; còn lại (timeout/kết nối) là lỗi phía server
+        error_type = LLMError if isinstance(error, ValueError) else LLMServerError
+        return error_type(f"Stream từ {backend.url} bị ngắt: {error}")
+
+    def _open(self, payload: Dict, stream: bool = False):
+        """POST /completion với chọn backend + retry; trả về (backend, response 2xx) hoặc ném LLMError
+
+        Backend vẫn được tính là đang chạy request cho tới khi gọi self.backends.release().
+        """
+        data = json.dumps(payload)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self._backoff(attempt))
+            backend = self.backends.acquire()
+            try:
+                response = self.session.post(f"{backend.url}/completion", data=data, timeout=self.timeout,
+                                             stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = self._retry_failure(backend, e)
+                continue
+
+            if _is_retryable_status(response.status_code):
+                response.close()
+                last_error = self._retry_failure(backend, LLMError(f"{backend.url} trả về HTTP {response.status_code}"))
+                continue
+
+            if response.status_code >= 400:
+                error = self._request_failure(backend, response.status_code, response.text)
+                response.close()
+                raise error
+            return backend, response
+        raise self._retries_exhausted(last_error)
+
+    def _post(self, payload: Dict):
+        """POST /completion, trả về JSON đã parse hoặc ném LLMError"""
+        backend, response = self._open(payload)
+        try:
+            result = response.json()
+        except ValueError as e:
+            raise self._invalid_response(backend, e) from e
+        self._succeeded(backend)
+        return result
+
+    def health(self) -> Dict:
+        """Trạng thái backend đã cache (health check nền + circuit breaker), không gọi HTTP"""
+        return self.backends.stats()
+
+    @property
+    def last_usage(self) -> Dict:
+        """Token/thời gian của lần gọi gần nhất trong thread (hoặc asyncio task) hiện tại"""
+        return _last_usage.get()
+
+    def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                      stop_when: Callable[[str], bool] = None) -> str:
+        """Gọi API của llama-server
+
+        Có stop_when thì dùng chế độ stream và dừng ngay khi stop_when(nội dung đã nhận) trả True.
+        """
+
+        if stop_when is not None:
+            result = self.stream_complete(prompt, max_tokens, temperature, enable_thinking, stop_when=stop_when)
+        else:
+            result = self.complete(prompt, max_tokens, temperature, enable_thinking)
+        return result.get("content", "").strip()
+
+    def complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                 **options) -> Dict:
+        """Gọi /completion, trả về toàn bộ response JSON; ném LLMError nếu thất bại
+
+        options được gửi thẳng cho llama-server (grammar, json_schema, n_probs, ...)
+        """
+
+        payload = self._request_payload(prompt, max_tokens, temperature, enable_thinking, options)
+        start = time.perf_counter()
         try:
-            response = requests.post(
-                f"{self.base_url}/completion",
+            result = self._post(payload)
+        except LLMError as e:
+            logging.error(f"Error calling Qwen3 API: {e}")
+            _record_error(start, e)
+            raise
+        _last_usage.set(_usage_from_response(result, (time.perf_counter() - start) * 1000))
+        return result
+
+    def stream_complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1,
+                        enable_thinking: bool = False, stop_when: Callable[[str], bool] = None, **options) -> Dict:
+        """Gọi /completion với stream=True, đọc token theo server-sent events khi server sinh ra
+
+        stop_when(nội dung đã nhận) được gọi sau mỗi chunk; trả True thì đóng kết nối ngay,
+        llama-server thấy client ngắt sẽ dừng sinh và giải phóng slot. Trả về dict như
+        complete() với "content" đã nhận và "stopped_early".
+        """
+
+        payload = self._request_payload(prompt, max_tokens, temperature, enable_thinking, options, stream=True)
+        start = time.perf_counter()
+        try:
+            backend, response = self._open(payload, stream=True)
+        except LLMError as e:
+            logging.error(f"Error calling Qwen3 API: {e}")
+            _record_error(start, e)
+            raise
+
+        reader = _StreamReader(start, stop_when)
+        success = False
+        try:
+            for line in response.iter_lines():
+                if reader.feed(line):
+                    break
+            success = True
+        except (requests.RequestException, ValueError) as e:
+            raise self._stream_failure(backend, start, e) from e
+        finally:
+            # Đóng hẳn kết nối (không trả về pool) để server thấy client ngắt khi dừng sớm
+            response.close()
+            self.backends.release(backend, success=success)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="ok")
+        return reader.result()
+
+    def complete_many(self, prompts: List[str], max_tokens: int = 512, temperature: float = 0.1,
+                      enable_thinking: bool = False, **options) -> List[tuple]:
+        """Gửi nhiều prompt trong một request /completion (multi-prompt của llama-server)
+
+        Trả về list (response, usage) theo thứ tự prompts; ném LLMError nếu request thất bại.
+        """
+
+        payload = self._many_payload(prompts, max_tokens, temperature, enable_thinking, options)
+        start = time.perf_counter()
+        try:
+            return self._many_results(self._post(payload), prompts, start)
+        except LLMError as e:
+            logging.error(f"Error calling Qwen3 API: {e}")
+            raise
+
+    def close(self):
+        self.backends.close()
+        self.session.close()
+
+class AsyncQwen3Client(Qwen3Client):
+    """Phiên bản asyncio của Qwen3Client (dùng aiohttp), cùng contract và cùng cách dựng payload/đọc response
+
+    Chỉ phần I/O (mở request, đọc body/stream) là async; mọi method gọi LLM đều là coroutine.
+    """
+
+    def __init__(self, base_url: Union[str, List[str]] = "http://localhost:8080", pool_size: int = 100,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0, cache_prompt: bool = True,
+                 max_retries: int = 2, backoff_base: float = 0.2, backoff_max: float = 2.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0, health_interval: float = 10.0):
+        self.base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.base_url = self.base_urls[0]
+        self.backends = BackendPool(self.base_urls, failure_threshold=failure_threshold,
+                                    reset_timeout=reset_timeout, health_interval=health_interval)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.headers = {"Content-Type": "application/json"}
+        self.cache_prompt = cache_prompt
+        self.slots = 0
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = None
+
+    def _get_session(self):
+        # Session phải được tạo bên trong event loop
+        if self.session is None or self.session.closed:
+            import aiohttp
+
+            self.session = aiohttp.ClientSession(
                 headers=self.headers,
-                data=json.dumps(payload),
-                timeout=30
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
             )
-            response.raise_for_status()
-            result = response.json()
-            return result.get("content", "").strip()
-        except Exception as e:
+        return self.session
+
+    async def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                            stop_when: Callable[[str], bool] = None) -> str:
+        """Gọi API của llama-server (async)"""
+
+        if stop_when is not None:
+            result = await self.stream_complete(prompt, max_tokens, temperature, enable_thinking, stop_when=stop_when)
+        else:
+            result = await self.complete(prompt, max_tokens, temperature, enable_thinking)
+        return result.get("content", "").strip()
+
+    async def complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                       **options) -> Dict:
+        """Gọi /completion (async), trả về toàn bộ response JSON; ném LLMError nếu thất bại"""
+
+        payload = self._request_payload(prompt, max_tokens, temperature, enable_thinking, options)
+        start = time.perf_counter()
+        try:
+            result = await self._post(payload)
+        except LLMError as e:
+            logging.error(f"Error calling Qwen3 API: {e}")
+            _record_error(start, e)
+            raise
+        _last_usage.set(_usage_from_response(result, (time.perf_counter() - start) * 1000))
+        return result
+
+    async def _open(self, payload: Dict):
+        """Như Qwen3Client._open: trả về (backend, response 2xx); gọi response.release() khi đọc xong"""
+        import aiohttp
+
+        data = json.dumps(payload)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt))
+            backend = self.backends.acquire()
+            try:
+                response = await self._get_session().post(f"{backend.url}/completion", data=data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                last_error = self._retry_failure(backend, e)
+                continue
+
+            if _is_retryable_status(response.status):
+                response.release()
+                last_error = self._retry_failure(backend, LLMError(f"{backend.url} trả về HTTP {response.status}"))
+                continue
+
+            if response.status >= 400:
+                error = self._request_failure(backend, response.status, await response.text())
+                response.release()
+                raise error
+            return backend, response
+        raise self._retries_exhausted(last_error)
+
+    async def _post(self, payload: Dict):
+        import aiohttp
+
+        backend, response = await self._open(payload)
+        try:
+            result = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise self._invalid_response(backend, e) from e
+        finally:
+            response.release()
+        self._succeeded(backend)
+        return result
+
+    async def stream_complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1,
+                              enable_thinking: bool = False, stop_when: Callable[[str], bool] = None,
+                              **options) -> Dict:
+        """Gọi /completion với stream=True (async), xem Qwen3Client.stream_complete"""
+        import aiohttp
+
+        payload = self._request_payload(prompt, max_tokens, temperature, enable_thinking, options, stream=True)
+        start = time.perf_counter()
+        try:
+            backend, response = await self._open(payload)
+        except LLMError as e:
             logging.error(f"Error calling Qwen3 API: {e}")
-            return ""
\ No newline at end of file
+            _record_error(start, e)
+            raise
+
+        reader = _StreamReader(start, stop_when)
+        success = False
+        try:
+            async for line in response.content:
+                if reader.feed(line):
+                    break
+            success = True
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise self._stream_failure(backend, start, e) from e
+        finally:
+            # Đóng hẳn kết nối (không trả về pool) để server thấy client ngắt khi dừng sớm
+            response.close()
+            self.backends.release(backend, success=success)
+        LLM_REQUESTS_TOTAL.inc(backend=backend.url, status="ok")
+        return reader.result()
+
+    async def complete_many(self, prompts: List[str], max_tokens: int = 512, temperature: float = 0.1,
+                            enable_thinking: bool = False, **options) -> List[tuple]:
+        """Multi-prompt (async), xem Qwen3Client.complete_many"""
+
+        payload = self._many_payload(prompts, max_tokens, temperature, enable_thinking, options)
+        start = time.perf_counter()
+        try:
+            return self._many_results(await self._post(payload), prompts, start)
+        except LLMError as e:
+            logging.error(f"Error calling Qwen3 API: {e}")
+            raise
+
+    async def close(self):
+        # Chờ thread health check dừng ở thread khác, không chặn event loop
+        await asyncio.to_thread(self.backends.close)
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
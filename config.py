@@ -0,0 +1,75 @@
+import os
+from typing import Dict, Mapping
+
+# Cấu hình server; mỗi khóa đọc được từ biến môi trường cùng tên (ví dụ LLAMA_SERVER_URLS=...)
+DEFAULT_CONFIG = {
+    # Nhiều llama-server cách nhau bằng dấu phẩy
+    "LLAMA_SERVER_URLS": "http://localhost:8080",
+    "LLAMA_CONNECT_TIMEOUT": 5.0,
+    "LLAMA_READ_TIMEOUT": 30.0,
+    "LLAMA_POOL_SIZE": 16,
+    "LLAMA_MAX_RETRIES": 2,
+    "LLAMA_SLOTS": 0,
+    # Tự điều chỉnh số request đồng thời theo thời gian chờ slot của llama-server
+    "LLAMA_ADAPTIVE_CONCURRENCY": False,
+    "LLAMA_TARGET_QUEUE_MS": 100.0,
+    "LLAMA_MAX_CONCURRENCY": 64,
+    "LLAMA_QUEUE_TIMEOUT": 10.0,
+    "BATCH_MAX_SIZE": 0,
+    "BATCH_MAX_WAIT_MS": 5.0,
+    "EARLY_STOP": False,
+    # File JSON cây loại tài liệu; rỗng: hai loại mặc định (Thông báo, Tài chính)
+    "TAXONOMY_PATH": "",
+    "RESULT_CACHE_PATH": "result_cache.db",
+    "PREFILTER_PATH": "prefilter_model.json",
+    "PREFILTER_THRESHOLD": 0.9,
+    "DEDUP_PATH": "dedup_index.db",
+    # OCR cho PDF scan (cần tesseract + gói ngôn ngữ vie); 0 process: tắt
+    "OCR_WORKERS": 0,
+    "OCR_DPI": 200,
+    "OCR_LANG": "vie",
+    "OCR_TOP_RATIO": 0.4,
+    "OCR_TIMEOUT": 30.0,
+    "JOBS_DB_PATH": "jobs.db",
+    "JOB_WORKERS": 4,
+    "JOB_MAX_QUEUE": 100,
+    "MAX_CONTENT_LENGTH": 16 * 1024 * 1024,
+    # Serving: số process worker, số thread mỗi worker. Metric (/metrics) nằm trong bộ nhớ từng
+    # process nên mặc định 1 worker; tăng tải bằng THREADS (phần nặng là chờ I/O tới llama-server)
+    "HOST": "0.0.0.0",
+    "PORT": 5000,
+    "WORKERS": 1,
+    "THREADS": 16,
+    "TIMEOUT": 120,
+}
+
+_TRUE = {"1", "true", "yes", "on"}
+
+def _convert(value: str, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in _TRUE
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+def load_config(environ: Mapping[str, str] = None, **overrides) -> Dict:
+    """DEFAULT_CONFIG, ghi đè bởi biến môi trường rồi tới overrides
+
+    Giá trị môi trường được ép về kiểu của giá trị mặc định; chuỗi rỗng
+    cho các đường dẫn nghĩa là tắt tính năng tương ứng.
+    """
+    environ = os.environ if environ is None else environ
+    config = dict(DEFAULT_CONFIG)
+    for key, default in DEFAULT_CONFIG.items():
+        if key in environ:
+            try:
+                config[key] = _convert(environ[key], default)
+            except ValueError:
+                raise ValueError(f"Giá trị không hợp lệ cho {key}: {environ[key]!r}") from None
+    config.update(overrides)
+    return config
+
+def llama_server_urls(config: Dict) -> list:
+    return [url.strip() for url in config["LLAMA_SERVER_URLS"].split(",") if url.strip()]
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from prefilter import normalize_text
+
+SIMHASH_BITS = 64
+# 4 dải 16 bit: hai SimHash lệch <= 3 bit chắc chắn trùng nhau ở ít nhất một dải (nguyên lý Dirichlet)
+BANDS = 4
+BAND_BITS = SIMHASH_BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+_DIGITS = re.compile(r"\d+")
+_WORD = re.compile(r"\w+")
+
+def _features(text: str, shingle_size: int = 3) -> Dict[str, int]:
+    """Shingle 3 từ của văn bản đã chuẩn hóa; mọi dãy số được thay bằng "0"
+    để các văn bản theo mẫu chỉ khác ngày tháng/số liệu cho cùng đặc trưng"""
+    words = _WORD.findall(_DIGITS.sub("0", normalize_text(text)))
+    features = {}
+    for i in range(max(1, len(words) - shingle_size + 1)):
+        shingle = " ".join(words[i:i + shingle_size])
+        if shingle:
+            features[shingle] = features.get(shingle, 0) + 1
+    return features
+
+def simhash(text: str) -> Optional[int]:
+    """SimHash 64 bit (trọng số = số lần xuất hiện shingle); None nếu văn bản không có từ nào"""
+    return _simhash_features(_features(text))
+
+def _simhash_features(features: Dict[str, int]) -> Optional[int]:
+    if not features:
+        return None
+    weights = [0] * SIMHASH_BITS
+    for feature, count in features.items():
+        h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+def _to_signed(value: int) -> int:
+    # SQLite INTEGER là số có dấu 64 bit
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+def _bands(value: int) -> list:
+    return [(value >> (band * BAND_BITS)) & BAND_MASK for band in range(BANDS)]
+
+class NearDuplicateIndex:
+    """Chỉ mục SimHash trên đĩa (SQLite) để tìm tài liệu gần trùng đã phân loại
+
+    Mỗi SimHash được chia thành 4 dải 16 bit, mỗi dải có index riêng: tra cứu chỉ
+    đọc các bản ghi trùng ít nhất một dải (trung bình N / 65536 bản ghi mỗi dải),
+    rồi so khoảng cách Hamming, nên vẫn dưới 1ms với hàng triệu bản ghi.
+
+    Mỗi bản ghi thuộc một namespace (taxonomy + chế độ phân loại đã tạo ra kết
+    quả); tra cứu chỉ xét bản ghi cùng namespace, nên đổi taxonomy không trả về
+    loại của cây cũ.
+    """
+
+    def __init__(self, path: str = "dedup_index.db", max_distance: int = 3, min_features: int = 8):
+        if not 0 <= max_distance < BANDS:
+            raise ValueError(f"max_distance phải trong khoảng 0..{BANDS - 1}")
+        self.path = path
+        self.max_distance = max_distance
+        self.min_features = min_features
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                simhash INTEGER NOT NULL,
+                band0 INTEGER NOT NULL,
+                band1 INTEGER NOT NULL,
+                band2 INTEGER NOT NULL,
+                band3 INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                namespace TEXT NOT NULL DEFAULT ''
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        if "namespace" not in columns:
+            # Chỉ mục tạo trước khi có namespace: bản ghi cũ mang namespace rỗng, không khớp tra cứu mới
+            self._conn.execute("ALTER TABLE documents ADD COLUMN namespace TEXT NOT NULL DEFAULT ''")
+        for band in range(BANDS):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_documents_band{band} ON documents(band{band})")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def fingerprint(self, text: str) -> Optional[int]:
+        """SimHash của văn bản, None nếu quá ngắn để so gần trùng đáng tin cậy"""
+        features = _features(text)
+        if len(features) < self.min_features:
+            return None
+        return _simhash_features(features)
+
+    def lookup(self, fingerprint: int, namespace: str = "") -> Optional[Dict]:
+        """Bản ghi gần nhất trong ngưỡng thuộc `namespace`: {"id", "distance", "result"} hoặc None"""
+        bands = _bands(fingerprint)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, simhash, result FROM documents "
+                "WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND namespace = ?",
+                bands + [namespace]
+            ).fetchall()
+        best = None
+        for doc_id, other, result in rows:
+            distance = bin((fingerprint ^ other) & ((1 << SIMHASH_BITS) - 1)).count("1")
+            if distance <= self.max_distance and (best is None or distance < best[1]):
+                best = (doc_id, distance, result)
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"id": best[0], "distance": best[1], "result": json.loads(best[2])}
+
+    def add(self, fingerprint: int, result: Dict, namespace: str = "") -> Optional[int]:
+        with self._lock:
+            try:
+                cursor = self._conn.execute(
+                    "INSERT INTO documents (simhash, band0, band1, band2, band3, result, created_at, namespace) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [_to_signed(fingerprint)] + _bands(fingerprint) +
+                    [json.dumps(result, ensure_ascii=False), time.time(), namespace]
+                )
+                self._conn.commit()
+                self._size += 1
+                return cursor.lastrowid
+            except sqlite3.Error as e:
+                logging.error(f"Error writing near-duplicate index: {e}")
+                return None
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._size,
+            "max_distance": self.max_distance
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
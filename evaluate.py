@@ -0,0 +1,226 @@
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence, Union
+
+import numpy as np
+
+from backends import LLMError
+from cache import ResultCache, hash_key
+from classify import DocumentClassifier
+from client import Qwen3Client, set_last_usage
+from prefilter import load_training_data
+from processor import DocumentProcessor
+from taxonomy import load_taxonomy
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+EVAL_MODES = ("summarize", "direct", "constrained")
+
+class ReplayClient:
+    """Lưu phản hồi thô của llama-server theo (prompt, tham số sinh) để chạy lại không cần sinh
+
+    Cùng interface với Qwen3Client (generate_text/complete/last_usage). Đổi parser
+    thì mọi phản hồi được phát lại từ cache; đổi prompt thì chỉ prompt mới phải sinh.
+    replay_only=True: prompt chưa có trong cache ném LLMError thay vì gọi server.
+    """
+
+    def __init__(self, client: Qwen3Client, responses: ResultCache, tag: str = "", replay_only: bool = False):
+        self.client = client
+        self.responses = responses
+        # Đổi tag khi đổi model/quantization để không phát lại phản hồi của model cũ
+        self.tag = tag
+        self.replay_only = replay_only
+        self.generated = 0
+        self.replayed = 0
+
+    @property
+    def last_usage(self) -> Dict:
+        return self.client.last_usage
+
+    def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                      stop_when: Callable[[str], bool] = None) -> str:
+        # Luôn lưu phản hồi đầy đủ, không dừng sớm, để phát lại được cho mọi parser
+        result = self.complete(prompt, max_tokens, temperature, enable_thinking)
+        return result.get("content", "").strip()
+
+    def complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                 **options) -> Dict:
+        params = dict(options, max_tokens=max_tokens, temperature=temperature, enable_thinking=enable_thinking)
+        key = hash_key(self.tag, prompt, json.dumps(params, sort_keys=True, ensure_ascii=False))
+        result = self.responses.get("response", key)
+        if result is not None:
+            self.replayed += 1
+            set_last_usage({"replayed": True})
+            return result
+        if self.replay_only:
+            set_last_usage({"error": "not in replay cache"})
+            raise LLMError("Prompt chưa có trong cache phản hồi (replay_only)")
+
+        result = self.client.complete(prompt, max_tokens, temperature, enable_thinking, **options)
+        self.responses.set("response", key, result)
+        self.generated += 1
+        return result
+
+def classify_sample(processor: DocumentProcessor, classifier: DocumentClassifier, text: str, mode: str) -> Dict:
+    if mode == "direct":
+        return classifier.classify_direct(text)
+    if mode == "constrained":
+        return classifier.classify_constrained(text)
+    return classifier.classify_document(processor.summarize_text(text))
+
+def run_predictions(processor: DocumentProcessor, classifier: DocumentClassifier, texts: Sequence[str],
+                    mode: str = "direct", workers: int = 8) -> List[Dict]:
+    """Phân loại song song, giữ thứ tự; lỗi của từng mẫu được ghi vào kết quả thay vì dừng cả lượt"""
+
+    def one(text):
+        try:
+            return classify_sample(processor, classifier, text, mode)
+        except LLMError as e:
+            return {"error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(one, texts))
+
+def compute_metrics(labels: Sequence[int], predictions: Sequence[int], confidences: Sequence[float],
+                    classes: Union[int, Sequence[int]], n_bins: int = 10) -> Dict:
+    """Ma trận nhầm lẫn, precision/recall/F1 từng lớp và độ hiệu chỉnh độ tin cậy
+
+    classes: id các loại (taxonomy nhiều cấp có id không liên tục, ví dụ 11, 12, 21),
+    hoặc số lớp n nghĩa là 0..n-1; nhãn thật ngoài danh sách được thêm vào.
+    Hàng/cột ma trận nhầm lẫn theo thứ tự `classes` trong kết quả.
+    predictions = -1 hoặc id không thuộc classes là mẫu lỗi/nhãn không hợp lệ: được
+    tính vào cột cuối của ma trận nhầm lẫn và luôn tính là sai.
+    macro_f1 chỉ lấy trung bình trên lớp có mẫu thật hoặc dự đoán; macro_f1_all trên mọi lớp.
+    """
+    if isinstance(classes, int):
+        classes = range(classes)
+    classes = sorted(set(classes) | set(labels))
+    index = {class_id: i for i, class_id in enumerate(classes)}
+    n_classes = len(classes)
+
+    y_true = np.asarray([index[label] for label in labels], dtype=np.int64)
+    y_pred = np.asarray([index.get(prediction, -1) for prediction in predictions], dtype=np.int64)
+    confidence = np.clip(np.asarray(confidences, dtype=np.float64), 0.0, 1.0)
+    n = len(y_true)
+
+    invalid = y_pred < 0
+    pred_column = np.where(invalid, n_classes, y_pred)
+    confusion = np.bincount(y_true * (n_classes + 1) + pred_column,
+                            minlength=n_classes * (n_classes + 1)).reshape(n_classes, n_classes + 1)
+
+    true_positive = np.diag(confusion[:, :n_classes]).astype(np.float64)
+    predicted = confusion[:, :n_classes].sum(axis=0)
+    actual = confusion.sum(axis=1)
+    precision = np.divide(true_positive, predicted, out=np.zeros(n_classes), where=predicted > 0)
+    recall = np.divide(true_positive, actual, out=np.zeros(n_classes), where=actual > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(n_classes),
+                   where=(precision + recall) > 0)
+    seen = (actual + predicted) > 0
+
+    # Hiệu chỉnh: chia độ tin cậy thành n_bins khoảng đều, so độ chính xác thực tế với độ tin cậy trung bình
+    correct = (y_pred == y_true) & ~invalid
+    confidence = np.where(invalid, 0.0, confidence)
+    bins = np.minimum((confidence * n_bins).astype(np.int64), n_bins - 1)
+    bin_count = np.bincount(bins, minlength=n_bins)
+    bin_correct = np.bincount(bins, weights=correct, minlength=n_bins)
+    bin_confidence = np.bincount(bins, weights=confidence, minlength=n_bins)
+    nonempty = bin_count > 0
+    bin_accuracy = np.divide(bin_correct, bin_count, out=np.zeros(n_bins), where=nonempty)
+    bin_mean_confidence = np.divide(bin_confidence, bin_count, out=np.zeros(n_bins), where=nonempty)
+    ece = float(np.sum(np.abs(bin_accuracy - bin_mean_confidence) * bin_count) / n) if n else 0.0
+
+    return {
+        "samples": n,
+        "accuracy": float(correct.mean()) if n else 0.0,
+        "invalid": int(invalid.sum()),
+        "macro_f1": float(f1[seen].mean()) if seen.any() else 0.0,
+        "macro_f1_all": float(f1.mean()) if n_classes else 0.0,
+        "classes": classes,
+        "confusion_matrix": confusion.tolist(),
+        "per_class": [
+            {"class": class_id, "precision": float(precision[c]), "recall": float(recall[c]), "f1": float(f1[c]),
+             "support": int(actual[c])}
+            for c, class_id in enumerate(classes)
+        ],
+        "calibration": {
+            "ece": ece,
+            "brier": float(np.mean((confidence - correct) ** 2)) if n else 0.0,
+            "bins": [
+                {"range": [b / n_bins, (b + 1) / n_bins], "count": int(bin_count[b]),
+                 "accuracy": float(bin_accuracy[b]), "confidence": float(bin_mean_confidence[b])}
+                for b in range(n_bins) if bin_count[b]
+            ]
+        }
+    }
+
+def format_report(metrics: Dict, categories: Dict[int, str]) -> str:
+    lines = [f"Mẫu: {metrics['samples']}  accuracy: {metrics['accuracy']:.2%}  "
+             f"macro-F1 (lớp có mẫu): {metrics['macro_f1']:.3f}  macro-F1 (mọi lớp): {metrics['macro_f1_all']:.3f}  "
+             f"lỗi/không hợp lệ: {metrics['invalid']}",
+             "",
+             "Ma trận nhầm lẫn (hàng: nhãn thật, cột: dự đoán, cột cuối: lỗi)"]
+    for c, row in zip(metrics["classes"], metrics["confusion_matrix"]):
+        lines.append(f"  {categories.get(c, c)!s:>12} " + " ".join(f"{v:>7}" for v in row))
+    lines.append("")
+    for item in metrics["per_class"]:
+        lines.append(f"  {categories.get(item['class'], item['class'])!s:>12}  precision={item['precision']:.3f}  "
+                     f"recall={item['recall']:.3f}  f1={item['f1']:.3f}  support={item['support']}")
+    calibration = metrics["calibration"]
+    lines.append("")
+    lines.append(f"Hiệu chỉnh độ tin cậy: ECE={calibration['ece']:.3f}  Brier={calibration['brier']:.3f}")
+    for b in calibration["bins"]:
+        lines.append(f"  [{b['range'][0]:.1f}, {b['range'][1]:.1f})  n={b['count']:<6} "
+                     f"accuracy={b['accuracy']:.2f}  confidence={b['confidence']:.2f}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Đánh giá DocumentClassifier trên tập dữ liệu có nhãn")
+    parser.add_argument("data", nargs="+", help="data.txt và/hoặc file JSONL/CSV có nhãn")
+    parser.add_argument("--mode", choices=EVAL_MODES, default="direct")
+    parser.add_argument("--url", nargs="+", default=["http://localhost:8080"], help="Địa chỉ llama-server")
+    parser.add_argument("--workers", type=int, default=8, help="Số mẫu gọi LLM đồng thời")
+    parser.add_argument("--taxonomy", default=None, help="File JSON cây loại tài liệu")
+    parser.add_argument("--limit", type=int, default=None, help="Chỉ đánh giá N mẫu đầu")
+    parser.add_argument("--responses", default="eval_responses.db", help="Cache phản hồi thô để phát lại")
+    parser.add_argument("--tag", default="", help="Nhãn model/phiên bản, là một phần khóa cache phản hồi")
+    parser.add_argument("--replay-only", action="store_true",
+                        help="Chỉ dùng phản hồi đã lưu, không gọi llama-server")
+    parser.add_argument("--predictions", help="Ghi dự đoán từng mẫu ra file JSONL")
+    parser.add_argument("-o", "--output", help="Ghi metric ra file JSON")
+    args = parser.parse_args()
+
+    texts, labels = load_training_data(args.data)
+    if args.limit:
+        texts, labels = texts[:args.limit], labels[:args.limit]
+
+    responses = ResultCache(args.responses, max_entries=10_000_000)
+    client = ReplayClient(Qwen3Client(args.url, pool_size=args.workers), responses, tag=args.tag,
+                          replay_only=args.replay_only)
+    processor = DocumentProcessor(client)
+    classifier = DocumentClassifier(client, taxonomy=load_taxonomy(args.taxonomy))
+
+    start = time.perf_counter()
+    results = run_predictions(processor, classifier, texts, mode=args.mode, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    predictions = [result.get("category_id", -1) if "error" not in result else -1 for result in results]
+    confidences = [result.get("confidence", 0.0) for result in results]
+    metrics = compute_metrics(labels, predictions, confidences, list(classifier.categories))
+    metrics.update(mode=args.mode, elapsed_s=elapsed, generated=client.generated, replayed=client.replayed)
+
+    print(format_report(metrics, classifier.categories))
+    print(f"\n{len(texts)} mẫu trong {elapsed:.1f}s ({client.generated} sinh mới, {client.replayed} phát lại)")
+
+    if args.predictions:
+        with open(args.predictions, 'w', encoding='utf-8') as f:
+            for text, label, result in zip(texts, labels, results):
+                f.write(json.dumps({"text": text[:200], "label": label, **result}, ensure_ascii=False) + "\n")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import logging
+import mmap
+import os
+import queue
+import struct
+import tarfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, Union
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar",)
+COMPRESSED_TAR_SUFFIXES = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_SUFFIXES = ZIP_SUFFIXES + TAR_SUFFIXES + COMPRESSED_TAR_SUFFIXES
+
+# Tên tài liệu nằm trong archive: "<đường dẫn archive>::<tên thành viên>"
+MEMBER_SEPARATOR = "::"
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_ZIP_LOCAL_MAGIC = b"PK\x03\x04"
+
+class PdfSource:
+    """Một PDF đầu vào, mô tả gọn để gửi sang process trích xuất (pickle vài chục byte)
+
+    kind:
+      "file"   - file PDF thường, process trích xuất tự mmap
+      "slice"  - PDF nằm nguyên vẹn trong archive (ZIP stored, TAR không nén):
+                 mmap archive và đọc thẳng vùng [offset, offset + size)
+      "zip"    - thành viên ZIP bị nén: process trích xuất tự giải nén (song song theo số core)
+      "bytes"  - nội dung đã đọc sẵn (thành viên của tar.gz/tar.xz, chỉ đọc tuần tự được)
+    """
+
+    __slots__ = ("kind", "name", "path", "offset", "size", "member", "data")
+
+    def __init__(self, kind: str, name: str, path: str = None, offset: int = 0, size: int = 0,
+                 member: str = None, data: bytes = None):
+        self.kind = kind
+        self.name = name
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.member = member
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"PdfSource({self.kind!r}, {self.name!r})"
+
+    @contextmanager
+    def buffer(self) -> Iterator[Union[bytes, memoryview]]:
+        """Nội dung PDF để đưa vào fitz.open(stream=...); với file/slice là memoryview trên mmap (không copy)
+
+        Document mở từ buffer phải được đóng trước khi thoát khỏi context.
+        """
+        if self.kind == "bytes":
+            yield self.data
+        elif self.kind == "zip":
+            with zipfile.ZipFile(self.path) as archive:
+                yield archive.read(self.member)
+        else:
+            with open(self.path, 'rb') as f:
+                size = self.size if self.kind == "slice" else os.fstat(f.fileno()).st_size
+                if size == 0:
+                    yield b""
+                    return
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)[self.offset:self.offset + size]
+                    try:
+                        yield view
+                    finally:
+                        view.release()
+
+    def prefetch(self):
+        """Báo kernel đọc trước vùng dữ liệu vào page cache (không chặn, không copy)"""
+        if self.kind not in ("file", "slice") or not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, self.offset, self.size, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+def _is_pdf(name: str) -> bool:
+    return name.lower().endswith(".pdf")
+
+def _zip_sources(path: str) -> Iterator[PdfSource]:
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.is_dir() or not _is_pdf(info.filename):
+                continue
+            name = f"{path}{MEMBER_SEPARATOR}{info.filename}"
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                # Vị trí dữ liệu = sau local header; độ dài extra của local header có thể khác central directory
+                f.seek(info.header_offset)
+                header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+                if header[0] == _ZIP_LOCAL_MAGIC:
+                    offset = info.header_offset + _ZIP_LOCAL_HEADER.size + header[9] + header[10]
+                    yield PdfSource("slice", name, path=path, offset=offset, size=info.file_size)
+                    continue
+            yield PdfSource("zip", name, path=path, member=info.filename)
+
+def _tar_sources(path: str) -> Iterator[PdfSource]:
+    with tarfile.open(path, "r:") as archive:
+        for member in archive:
+            if member.isfile() and _is_pdf(member.name):
+                yield PdfSource("slice", f"{path}{MEMBER_SEPARATOR}{member.name}", path=path,
+                                offset=member.offset_data, size=member.size)
+
+def _compressed_tar_sources(path: str) -> Iterator[PdfSource]:
+    # Archive nén chỉ đọc tuần tự được: đọc nội dung ngay trong thread đọc trước
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and _is_pdf(member.name):
+                data = archive.extractfile(member).read()
+                yield PdfSource("bytes", f"{path}{MEMBER_SEPARATOR}{member.name}", data=data, size=len(data))
+
+def archive_sources(path: str) -> Iterator[PdfSource]:
+    lower = path.lower()
+    if lower.endswith(ZIP_SUFFIXES):
+        return _zip_sources(path)
+    if lower.endswith(COMPRESSED_TAR_SUFFIXES):
+        return _compressed_tar_sources(path)
+    return _tar_sources(path)
+
+def iter_pdf_sources(inputs: Iterable[str]) -> Iterator[PdfSource]:
+    """Liệt kê PDF từ danh sách file/thư mục/archive (ZIP, TAR, tar.gz...), thư mục được duyệt đệ quy"""
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if _is_pdf(name):
+                        yield PdfSource("file", path, path=path)
+                    elif name.lower().endswith(ARCHIVE_SUFFIXES):
+                        yield from _safe_archive_sources(path)
+        elif item.lower().endswith(ARCHIVE_SUFFIXES):
+            yield from _safe_archive_sources(item)
+        else:
+            yield PdfSource("file", item, path=item)
+
+def _safe_archive_sources(path: str) -> Iterator[PdfSource]:
+    try:
+        yield from archive_sources(path)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        logging.error(f"Error reading archive {path}: {e}")
+
+class PrefetchReader:
+    """Thread đọc trước: liệt kê archive, đọc thành viên nén và gợi ý page cache trước khi cần
+
+    Giữ tối đa `max_prefetch` nguồn đã sẵn sàng trong hàng đợi, nên các process
+    trích xuất không phải chờ việc đọc đĩa/giải nén tuần tự, còn bộ nhớ vẫn có giới hạn.
+    """
+
+    _DONE = object()
+
+    def __init__(self, sources: Iterable[PdfSource], max_prefetch: int = 32):
+        self._sources = sources
+        self._queue = queue.Queue(maxsize=max_prefetch)
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="pdf-prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for source in self._sources:
+                if self._stopped.is_set():
+                    return
+                source.prefetch()
+                self._put(source)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._put(self._DONE)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self) -> Iterator[PdfSource]:
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+
+    def close(self):
+        self._stopped.set()
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class QueueFullError(Exception):
+    pass
+
+_owner_lock = threading.Lock()
+_owner = (None, None)
+
+def process_owner_id() -> str:
+    """Định danh process hiện tại ghi vào cột owner của job
+
+    PID có thể bị process khác dùng lại (nhất là trong container, PID 1 luôn là
+    server), nên mỗi lần khởi động process sinh một id mới; tính lại sau fork.
+    """
+    global _owner
+    with _owner_lock:
+        pid, owner = _owner
+        if pid != os.getpid():
+            _owner = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex}")
+        return _owner[1]
+
+class JobStore:
+    """Lưu trạng thái và kết quả job trong SQLite để không mất khi khởi động lại
+
+    Mỗi process ghi heartbeat vào bảng `owners` mỗi `heartbeat_interval` giây;
+    owner không có heartbeat trong `stale_after` giây (hoặc không có trong bảng)
+    được coi là đã dừng và job chưa xong của nó bị đánh dấu failed.
+    """
+
+    def __init__(self, path: str = "jobs.db", heartbeat_interval: float = 10.0, stale_after: float = 30.0):
+        self.path = path
+        self.owner = process_owner_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                mode TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS owners (
+                id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            )
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self._heartbeat()
+        self._fail_orphaned_jobs()
+        self._conn.commit()
+
+        self._heartbeat_thread = None
+        if heartbeat_interval > 0:
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        self._conn.execute("INSERT OR REPLACE INTO owners (id, heartbeat) VALUES (?, ?)", (self.owner, time.time()))
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                with self._lock:
+                    self._heartbeat()
+                    self._fail_orphaned_jobs()
+                    self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing job heartbeat: {e}")
+
+    def _fail_orphaned_jobs(self):
+        """Dữ liệu PDF của job chưa chạy xong chỉ nằm trong bộ nhớ của process nhận job:
+        job của process đã dừng không thể tiếp tục. Job của worker khác còn heartbeat được giữ nguyên.
+
+        Owner cũ dạng PID (trước khi có heartbeat) không còn kiểm chứng được nên cũng bị coi là đã dừng.
+        """
+        now = time.time()
+        self._conn.execute("DELETE FROM owners WHERE heartbeat < ? AND id != ?", (now - self.stale_after, self.owner))
+        alive = {row[0] for row in self._conn.execute("SELECT id FROM owners")}
+        owners = [row[0] for row in self._conn.execute(
+            "SELECT DISTINCT owner FROM jobs WHERE status IN ('queued', 'running')")]
+        dead = [owner for owner in owners if owner not in alive]
+        if not dead:
+            return
+        error = json.dumps({"error": "Job bị gián đoạn do server khởi động lại"}, ensure_ascii=False)
+        for owner in dead:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', result = ?, updated_at = ? "
+                "WHERE status IN ('queued', 'running') AND owner IS ?",
+                (error, now, owner)
+            )
+
+    def create(self, job_id: str, filename: str, mode: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, filename, mode, status, created_at, updated_at, owner) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, filename, mode, now, now, self.owner)
+            )
+            self._conn.commit()
+
+    def update(self, job_id: str, status: str, result: Dict = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, time.time(), job_id)
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        jobs = self.get_many([job_id])
+        return jobs[0] if jobs else None
+
+    def get_many(self, job_ids: List[str]) -> List[Dict]:
+        if not job_ids:
+            return []
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, filename, mode, status, result, created_at, updated_at FROM jobs WHERE id IN ({placeholders})",
+                job_ids
+            ).fetchall()
+        by_id = {row[0]: self._row_to_dict(row) for row in rows}
+        return [by_id[job_id] for job_id in job_ids if job_id in by_id]
+
+    def close(self):
+        """Dừng heartbeat và đóng kết nối; job chưa xong bị đánh dấu failed khi heartbeat hết hạn"""
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _row_to_dict(row) -> Dict:
+        return {
+            "id": row[0],
+            "filename": row[1],
+            "mode": row[2],
+            "status": row[3],
+            "result": json.loads(row[4]) if row[4] else None,
+            "created_at": row[5],
+            "updated_at": row[6]
+        }
+
+class JobQueue:
+    """Hàng đợi giới hạn + pool worker thread chạy DocumentAnalyzer
+
+    submit() ném QueueFullError khi hàng đợi đầy để API trả 429.
+    """
+
+    def __init__(self, analyzer, store: JobStore, workers: int = 4, max_queue: int = 100):
+        self.analyzer = analyzer
+        self.store = store
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._submit_lock = threading.Lock()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit_many(self, documents: List[tuple]) -> List[str]:
+        """Thêm nhiều tài liệu (filename, pdf_data, mode); hoặc nhận tất cả, hoặc không nhận cái nào"""
+        with self._submit_lock:
+            if self._queue.qsize() + len(documents) > self.max_queue:
+                raise QueueFullError(f"Hàng đợi đầy ({self._queue.qsize()}/{self.max_queue})")
+
+            job_ids = []
+            for filename, pdf_data, mode in documents:
+                job_id = uuid.uuid4().hex
+                self.store.create(job_id, filename, mode)
+                self._queue.put_nowait((job_id, pdf_data, mode))
+                job_ids.append(job_id)
+            return job_ids
+
+    def submit(self, filename: str, pdf_data: bytes, mode: str = "summarize") -> str:
+        return self.submit_many([(filename, pdf_data, mode)])[0]
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            "workers": len(self._workers)
+        }
+
+    def _run(self):
+        while True:
+            job_id, pdf_data, mode = self._queue.get()
+            try:
+                self.store.update(job_id, "running")
+                result = self.analyzer.analyze_bytes(pdf_data, mode=mode)
+                self.store.update(job_id, "failed" if "error" in result else "done", result)
+            except Exception as e:
+                logging.error(f"Error running job {job_id}: {e}")
+                self.store.update(job_id, "failed", {"error": f"Lỗi xử lý: {str(e)}"})
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,234 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from backends import LLMError, LLMServerError, LLMUnavailableError
+from client import Qwen3Client
+from metrics import REGISTRY
+
+LLM_CONCURRENCY_LIMIT = REGISTRY.gauge(
+    "llm_concurrency_limit", "Số request LLM đồng thời đang được phép (tự điều chỉnh)")
+LLM_IN_FLIGHT = REGISTRY.gauge(
+    "llm_in_flight", "Số request LLM đang chạy")
+LLM_QUEUE_DEPTH = REGISTRY.gauge(
+    "llm_queue_depth", "Số request LLM đang chờ vượt giới hạn đồng thời")
+LLM_SHED_TOTAL = REGISTRY.counter(
+    "llm_shed_total", "Số request LLM bị từ chối do quá tải", ["reason"])
+
+class LLMOverloadedError(LLMError):
+    """Request bị từ chối vì hàng đợi vượt giới hạn hoặc chờ quá lâu (load shedding)
+
+    retry_after: số giây gợi ý client chờ trước khi gửi lại (header Retry-After).
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdaptiveLimiter:
+    """Giới hạn số request LLM đồng thời, tự điều chỉnh theo độ trễ quan sát được (AIMD)
+
+    Tín hiệu tắc nghẽn chính là thời gian chờ trong hàng đợi của llama-server,
+    ước lượng bằng thời gian request phía client trừ thời gian xử lý server báo
+    cáo (prompt_ms + predicted_ms): slot rảnh thì gần 0, hết slot thì tăng ngay.
+    - Không tắc (chờ <= target_queue_ms, tổng thời gian <= target_latency_ms) và
+      đang dùng hết giới hạn: tăng cộng, khoảng +1 mỗi vòng request.
+    - Tắc hoặc timeout/lỗi kết nối/429/5xx: giảm nhân theo mức vượt ngưỡng (gradient),
+      không thấp hơn `backoff` lần; chỉ giảm một lần cho mỗi đợt tắc (các request
+      bắt đầu trước lần giảm gần nhất không làm giảm tiếp).
+    Request vượt giới hạn được xếp hàng theo thứ tự đến (FIFO, request mới không chen
+    lên trước) tối đa `queue_timeout` giây (None: chờ không giới hạn); hàng đợi dài hơn `max_queue` thì từ chối
+    ngay (LLMOverloadedError).
+    """
+
+    def __init__(self, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 64,
+                 target_queue_ms: float = 100.0, target_latency_ms: float = 20000.0, backoff: float = 0.5,
+                 max_queue: int = 256, queue_timeout: Optional[float] = 10.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.target_queue_ms = target_queue_ms
+        self.target_latency_ms = target_latency_ms
+        self.backoff = backoff
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = deque()
+        self.shed = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._publish()
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _publish(self):
+        LLM_CONCURRENCY_LIMIT.set(self.current_limit)
+        LLM_IN_FLIGHT.set(self.in_flight)
+        LLM_QUEUE_DEPTH.set(self.waiting)
+
+    def acquire(self) -> float:
+        """Chờ tới lượt; trả về thời điểm bắt đầu request (dùng cho release)"""
+        with self._cond:
+            if self.in_flight >= self.current_limit or self._waiters:
+                if self.waiting >= self.max_queue:
+                    self._reject("queue_full")
+                deadline = None if self.queue_timeout is None else time.monotonic() + self.queue_timeout
+                ticket = object()
+                self._waiters.append(ticket)
+                self._publish()
+                while self._waiters[0] is not ticket or self.in_flight >= self.current_limit:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._waiters.remove(ticket)
+                        self._cond.notify_all()
+                        self._reject("queue_timeout")
+                    self._cond.wait(remaining)
+                self._waiters.popleft()
+                # Giới hạn có thể còn chỗ cho request kế tiếp trong hàng
+                self._cond.notify_all()
+            self.in_flight += 1
+            self._publish()
+            return time.monotonic()
+
+    def _reject(self, reason: str):
+        self.shed += 1
+        LLM_SHED_TOTAL.inc(reason=reason)
+        # Gợi ý quay lại sau khoảng một lượt chờ tối đa của hàng đợi
+        raise LLMOverloadedError(f"Quá tải: {self.in_flight} request đang chạy, {self.waiting} đang chờ "
+                                 f"(giới hạn {self.current_limit}, {reason})",
+                                 retry_after=self.queue_timeout or 1.0)
+
+    def release(self, started: float, latency_ms: float, queue_ms: Optional[float], congested: bool = False):
+        """Ghi nhận kết quả một request và điều chỉnh giới hạn
+
+        queue_ms: thời gian chờ ở server (None nếu server không báo timings);
+        congested: request timeout/lỗi server, coi như tắc nghẽn.
+        """
+        with self._cond:
+            saturated = self.in_flight >= self.current_limit
+            self.in_flight -= 1
+            overshoot = 0.0
+            if congested:
+                overshoot = float("inf")
+            else:
+                if queue_ms is not None and queue_ms > self.target_queue_ms:
+                    overshoot = queue_ms / max(self.target_queue_ms, 1.0)
+                if latency_ms > self.target_latency_ms:
+                    overshoot = max(overshoot, latency_ms / self.target_latency_ms)
+
+            if overshoot > 1.0:
+                if started >= self._last_decrease:
+                    # Gradient: vượt ngưỡng càng nhiều giảm càng mạnh, tối đa giảm còn `backoff` lần
+                    self.limit = max(float(self.min_limit), self.limit * max(self.backoff, 1.0 / overshoot))
+                    self._last_decrease = time.monotonic()
+            elif saturated:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._publish()
+            self._cond.notify_all()
+
+    def release_unmeasured(self):
+        """Trả lượt mà không điều chỉnh giới hạn (lỗi không liên quan tải của server)"""
+        with self._cond:
+            self.in_flight -= 1
+            self._publish()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[Dict]:
+        """Giữ một lượt trong suốt lời gọi; người gọi ghi "queue_ms" (chờ ở server) vào dict được yield"""
+        started = self.acquire()
+        measured = {}
+        try:
+            yield measured
+        except LLMUnavailableError:
+            # Circuit breaker mở: không có request nào tới server, không phản ánh độ trễ
+            self.release_unmeasured()
+            raise
+        except LLMServerError:
+            # Timeout, lỗi kết nối, 429/5xx: server quá tải
+            self.release(started, (time.monotonic() - started) * 1000, None, congested=True)
+            raise
+        except LLMError:
+            # Lỗi do request (4xx, response/grammar không hợp lệ): không nói gì về tải của server
+            self.release_unmeasured()
+            raise
+        except BaseException:
+            self.release_unmeasured()
+            raise
+        self.release(started, (time.monotonic() - started) * 1000, measured.get("queue_ms"))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "limit": self.current_limit,
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "shed": self.shed,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "target_queue_ms": self.target_queue_ms
+            }
+
+def server_queue_ms(usage: Dict) -> Optional[float]:
+    """Thời gian request chờ ngoài phần server xử lý (chờ slot + mạng); None nếu thiếu timings"""
+    if not usage or "request_ms" not in usage or "prompt_ms" not in usage:
+        return None
+    return max(0.0, usage["request_ms"] - usage["prompt_ms"] - usage.get("predicted_ms", 0.0))
+
+class LimitedClient:
+    """Bọc Qwen3Client (cùng interface), mọi lời gọi đi qua AdaptiveLimiter"""
+
+    def __init__(self, client: Qwen3Client, limiter: AdaptiveLimiter):
+        self.client = client
+        self.limiter = limiter
+
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+
+    @property
+    def last_usage(self) -> Dict:
+        return self.client.last_usage
+
+    def health(self) -> Dict:
+        return self.client.health()
+
+    def _call(self, method: Callable, *args, **kwargs):
+        with self.limiter.slot() as measured:
+            result = method(*args, **kwargs)
+            measured["queue_ms"] = server_queue_ms(self.client.last_usage)
+            return result
+
+    def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                      stop_when: Callable[[str], bool] = None) -> str:
+        return self._call(self.client.generate_text, prompt, max_tokens, temperature, enable_thinking,
+                          stop_when=stop_when)
+
+    def stream_complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1,
+                        enable_thinking: bool = False, stop_when: Callable[[str], bool] = None, **options) -> Dict:
+        return self._call(self.client.stream_complete, prompt, max_tokens, temperature, enable_thinking,
+                          stop_when=stop_when, **options)
+
+    def complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                 **options) -> Dict:
+        return self._call(self.client.complete, prompt, max_tokens, temperature, enable_thinking, **options)
+
+    def complete_many(self, prompts: List[str], max_tokens: int = 512, temperature: float = 0.1,
+                      enable_thinking: bool = False, **options) -> List[tuple]:
+        # Một request nhiều prompt chiếm một lượt; lấy thời gian chờ nhỏ nhất trong batch
+        with self.limiter.slot() as measured:
+            outputs = self.client.complete_many(prompts, max_tokens, temperature, enable_thinking, **options)
+            queues = [server_queue_ms(usage) for _, usage in outputs]
+            measured["queue_ms"] = min((q for q in queues if q is not None), default=None)
+            return outputs
+
+    def close(self):
+        self.client.close()
@@ -1,27 +1,172 @@
+from backends import LLMError, LLMServerError, LLMUnavailableError
 from client import Qwen3Client
 from processor import DocumentProcessor
 from classify import DocumentClassifier
+from batch import run_pipeline
+from cache import ResultCache, hash_key, hash_file, hash_bytes
+from prefilter import FastClassifier
+from dedup import NearDuplicateIndex
+from ocr import OcrEngine
+from metrics import StageTimer, record_analysis
+from scheduler import BatchingClient
+from limiter import AdaptiveLimiter, LimitedClient, LLMOverloadedError
+from taxonomy import load_taxonomy
 import json
 import os
-from typing import Dict, List
+from typing import Dict, List, Iterable, Iterator, Union
 import logging
 import requests
 import time
 import re
 
+# summarize: tóm tắt rồi phân loại; direct: phân loại trực tiếp, một lần gọi LLM;
+# constrained: một lần gọi LLM, sinh đúng 1 token nhãn (grammar + xác suất token)
+ANALYSIS_MODES = ("summarize", "direct", "constrained")
+
+# Phần kết quả phân loại được lưu trong chỉ mục gần trùng để dùng lại
+DEDUP_RESULT_FIELDS = ("category", "category_id", "category_path", "confidence", "reason", "summary")
+
+def llm_error_kind(error: LLMError) -> str:
+    """Loại lỗi LLM, để tầng HTTP chọn status code
+
+    overloaded: bị từ chối do quá tải (load shedding); unavailable: llama-server
+    timeout/lỗi kết nối/429/5xx hoặc không còn backend; llm_error: response không hợp lệ.
+    """
+    if isinstance(error, LLMOverloadedError):
+        return "overloaded"
+    if isinstance(error, (LLMServerError, LLMUnavailableError)):
+        return "unavailable"
+    return "llm_error"
+
 class DocumentAnalyzer:
-    def __init__(self, llama_server_url: str = "http://localhost:8080"):
-        self.qwen_client = Qwen3Client(llama_server_url)
-        self.processor = DocumentProcessor(self.qwen_client)
-        self.classifier = DocumentClassifier(self.qwen_client)
+    def __init__(self, llama_server_url: Union[str, List[str]] = "http://localhost:8080", cache_path: str = None,
+                 cache_max_entries: int = 100000, prefilter_path: str = None, prefilter_threshold: float = 0.9,
+                 batch_max_size: int = 0, batch_max_wait_ms: float = 5.0, batch_slots: int = 4,
+                 batch_multi_prompt: bool = True, llm_slots: int = 0, early_stop: bool = False,
+                 dedup_path: str = None, dedup_max_distance: int = 3, taxonomy_path: str = None,
+                 ocr_workers: int = 0, ocr_options: Dict = None, adaptive_concurrency: bool = False,
+                 limiter_options: Dict = None, client_options: Dict = None):
+        # Nhiều URL: chia tải theo số request đang chạy, retry + circuit breaker cho từng server
+        # llm_slots > 0: ghim request vào slot của llama-server (bằng -np) để tái dùng KV cache của prefix
+        # client_options: tham số thêm cho Qwen3Client (timeout, pool_size, max_retries, ...)
+        self.qwen_client = Qwen3Client(llama_server_url, slots=llm_slots, **(client_options or {}))
+        
+        # adaptive_concurrency: giới hạn số request đồng thời, tự điều chỉnh theo thời gian chờ ở server
+        # limiter_options: tham số thêm cho AdaptiveLimiter (target_queue_ms, max_limit, queue_timeout, ...)
+        self.llm = self.qwen_client
+        self.limiter = None
+        if adaptive_concurrency:
+            self.limiter = AdaptiveLimiter(**(limiter_options or {}))
+            self.llm = LimitedClient(self.qwen_client, self.limiter)
+        
+        # batch_max_size > 0: gom prompt đồng thời thành batch trước khi gửi llama-server
+        if batch_max_size > 0:
+            self.llm = BatchingClient(self.llm, max_wait_ms=batch_max_wait_ms, max_batch=batch_max_size,
+                                      slots=batch_slots, multi_prompt=batch_multi_prompt)
+        
+        self.processor = DocumentProcessor(self.llm)
+        # early_stop: stream phản hồi phân loại, dừng ngay khi đã có nhãn + độ tin cậy
+        # taxonomy_path: file JSON cây loại tài liệu (None: hai loại mặc định)
+        self.classifier = DocumentClassifier(self.llm, early_stop=early_stop, taxonomy=load_taxonomy(taxonomy_path))
+        self._taxonomy_signature = json.dumps(self.classifier.taxonomy.spec, ensure_ascii=False, sort_keys=True)
+        self.cache = ResultCache(cache_path, cache_max_entries) if cache_path else None
+        
+        # Bộ phân loại cục bộ: trả lời ngay nếu đủ chắc chắn, còn lại mới gọi LLM
+        self.prefilter = None
+        self.prefilter_threshold = prefilter_threshold
+        if prefilter_path:
+            if os.path.exists(prefilter_path):
+                self.prefilter = FastClassifier.load(prefilter_path)
+                # Model huấn luyện trên bộ nhãn khác sẽ trả lời chắc chắn nhưng sai loại: không dùng
+                if not self.prefilter.matches(self.classifier.categories):
+                    logging.warning(f"Prefilter model {prefilter_path} does not match taxonomy "
+                                    f"'{self.classifier.taxonomy.name}', using LLM only")
+                    self.prefilter = None
+            else:
+                logging.warning(f"Prefilter model not found: {prefilter_path}, using LLM only")
+        
+        # Chỉ mục SimHash: tài liệu gần trùng với tài liệu đã phân loại dùng lại kết quả cũ
+        self.dedup = NearDuplicateIndex(dedup_path, max_distance=dedup_max_distance) if dedup_path else None
+        
+        # ocr_workers > 0: PDF không có lớp text (bản scan) được OCR trong process pool riêng
+        # ocr_options: tham số thêm cho OcrEngine (dpi, lang, top_ratio, timeout, ...)
+        self.ocr = OcrEngine(ocr_workers, **(ocr_options or {})) if ocr_workers > 0 else None
     
-    def analyze_document(self, pdf_path: str) -> Dict:
+    def analyze_document(self, pdf_path: str, mode: str = "summarize") -> Dict:
         """Phân tích và phân loại tài liệu PDF"""
         
         # Bước 1: Trích xuất trang đầu
         print("Đang trích xuất trang đầu...")
-        first_page_text = self.processor.extract_first_page(pdf_path)
+        timer = StageTimer()
+        first_page_text = self.processor.extract_first_page(pdf_path, timer)
+        used_ocr = not first_page_text and self.ocr is not None and self.ocr.available
+        if used_ocr:
+            print("Không có lớp text, đang OCR trang đầu...")
+            first_page_text = self.ocr.extract(pdf_path, timer)
+        pdf_hash = hash_file(pdf_path) if self.cache and first_page_text else None
+        
+        return self._mark_ocr(self.analyze_text(first_page_text, pdf_hash=pdf_hash, mode=mode, timer=timer), used_ocr)
+    
+    def analyze_bytes(self, pdf_data: bytes, mode: str = "summarize", timer: StageTimer = None) -> Dict:
+        """Phân tích PDF nằm trong bộ nhớ (ví dụ file upload), không qua file tạm"""
+        
+        timer = timer or StageTimer()
+        first_page_text = self.processor.extract_first_page_from_bytes(pdf_data, timer)
+        used_ocr = not first_page_text and self.ocr is not None and self.ocr.available
+        if used_ocr:
+            first_page_text = self.ocr.extract(pdf_data, timer)
+        pdf_hash = hash_bytes(pdf_data) if self.cache and first_page_text else None
         
+        result = self.analyze_text(first_page_text, show_progress=False, pdf_hash=pdf_hash, mode=mode, timer=timer)
+        return self._mark_ocr(result, used_ocr)
+    
+    @staticmethod
+    def _mark_ocr(result: Dict, used_ocr: bool) -> Dict:
+        # Nội dung lấy từ OCR có thể sai chính tả: ghi nguồn để người dùng cân nhắc độ tin cậy
+        if used_ocr:
+            result["text_source"] = "ocr"
+        return result
+    
+    def analyze_text(self, first_page_text: str, show_progress: bool = True, pdf_hash: str = None,
+                     mode: str = "summarize", timer: StageTimer = None) -> Dict:
+        """Phân loại nội dung trang đầu đã trích xuất
+
+        mode="summarize": tóm tắt rồi phân loại (2 lần gọi LLM)
+        mode="direct": phân loại trực tiếp trên văn bản gốc (1 lần gọi LLM)
+        mode="constrained": như direct nhưng chỉ sinh 1 token nhãn, độ tin cậy từ xác suất token
+
+        timer chứa thời gian các bước đã chạy trước đó (trích xuất); kết quả
+        trả về kèm "timings" (ms) và "llm_usage" (token, thời gian server).
+        """
+        if mode not in ANALYSIS_MODES:
+            raise ValueError(f"Chế độ không hợp lệ: {mode}")
+        
+        timer = timer or StageTimer()
+        start = time.perf_counter()
+        try:
+            result = self._analyze_text(first_page_text, show_progress, pdf_hash, mode, timer)
+        except LLMError as e:
+            # Không trả kết quả đoán mò khi llama-server lỗi/quá tải
+            logging.error(f"LLM unavailable: {e}")
+            result = {
+                "error": f"Không gọi được llama-server: {e}",
+                "error_kind": llm_error_kind(e),
+                "category": "Lỗi",
+                "confidence": 0.0
+            }
+            if isinstance(e, LLMOverloadedError):
+                result["retry_after"] = e.retry_after
+        
+        result["mode"] = mode
+        result["timings"] = dict(timer.timings, analyze_ms=(time.perf_counter() - start) * 1000)
+        if timer.llm:
+            result["llm_usage"] = timer.llm
+        record_analysis(result, timer)
+        
+        return result
+    
+    def _analyze_text(self, first_page_text: str, show_progress: bool, pdf_hash: str, mode: str,
+                      timer: StageTimer) -> Dict:
         if not first_page_text:
             return {
                 "error": "Không thể trích xuất nội dung từ PDF",
@@ -29,25 +174,161 @@ class DocumentAnalyzer:
                 "confidence": 0.0
             }
         
-        # Bước 2: Tóm tắt
-        print("Đang tóm tắt nội dung...")
-        summary = self.processor.summarize_text(first_page_text)
+        fingerprint = None
+        if self.dedup:
+            with timer.stage("dedup"):
+                fingerprint = self.dedup.fingerprint(first_page_text)
+                match = (self.dedup.lookup(fingerprint, self._dedup_namespace(mode))
+                         if fingerprint is not None else None)
+            if match:
+                return dict(
+                    match["result"],
+                    engine="near_duplicate",
+                    duplicate_of=match["id"],
+                    duplicate_distance=match["distance"],
+                    original_text_length=len(first_page_text),
+                    processing_steps=[
+                        "Trích xuất trang đầu",
+                        "Dùng lại kết quả của tài liệu gần trùng"
+                    ]
+                )
         
-        # Bước 3: Phân loại
-        print("Đang phân loại văn bản...")
-        classification_result = self.classifier.classify_document(summary)
+        prefilter_confidence = None
+        if self.prefilter:
+            with timer.stage("prefilter"):
+                category, prefilter_confidence = self.prefilter.predict(first_page_text)
+            if prefilter_confidence >= self.prefilter_threshold:
+                return {
+                    "category": self.classifier.categories.get(category, "Không xác định"),
+                    "category_id": category,
+                    "category_path": self.classifier.taxonomy.path(category),
+                    "confidence": prefilter_confidence,
+                    "reason": "Phân loại bởi bộ phân loại cục bộ",
+                    "summary": "",
+                    "engine": "prefilter",
+                    "original_text_length": len(first_page_text),
+                    "processing_steps": [
+                        "Trích xuất trang đầu",
+                        "Phân loại cục bộ"
+                    ]
+                }
+        
+        if mode in ("direct", "constrained"):
+            classification_result = self._classify_single_call(first_page_text, show_progress, pdf_hash, mode, timer)
+        else:
+            classification_result = self._summarize_and_classify(first_page_text, show_progress, pdf_hash, timer)
         
         # Thêm thông tin gốc
         classification_result["original_text_length"] = len(first_page_text)
+        classification_result["engine"] = "llm"
+        if prefilter_confidence is not None:
+            classification_result["prefilter_confidence"] = prefilter_confidence
+        
+        if (fingerprint is not None and "error" not in classification_result
+                and classification_result["reason"] != "Không có lý do"):
+            self.dedup.add(fingerprint, {key: classification_result[key] for key in DEDUP_RESULT_FIELDS
+                                         if key in classification_result}, self._dedup_namespace(mode))
+        
+        return classification_result
+    
+    def _dedup_namespace(self, mode: str) -> str:
+        """Kết quả gần trùng chỉ dùng lại khi cùng taxonomy và cùng chế độ phân loại"""
+        return hash_key(self._taxonomy_signature, mode)
+    
+    def _summarize_and_classify(self, first_page_text: str, show_progress: bool, pdf_hash: str,
+                                timer: StageTimer) -> Dict:
+        # Bước 2: Tóm tắt
+        if show_progress:
+            print("Đang tóm tắt nội dung...")
+        summary_key = None
+        summary = None
+        if self.cache:
+            summary_key = hash_key(pdf_hash, first_page_text, self.processor.cache_signature())
+            summary = self.cache.get("summary", summary_key)
+        summary_hit = summary is not None
+        if not summary_hit:
+            summary = self.processor.summarize_text(first_page_text, timer)
+            # Không lưu kết quả fallback khi LLM lỗi
+            if self.cache and (len(first_page_text) < 100 or summary != first_page_text[:500]):
+                self.cache.set("summary", summary_key, summary)
+        
+        # Bước 3: Phân loại
+        if show_progress:
+            print("Đang phân loại văn bản...")
+        classification_key = None
+        classification_result = None
+        if self.cache:
+            # Khóa phụ thuộc khóa tóm tắt: đổi prompt phân loại chỉ làm mất cache bước 3
+            classification_key = hash_key(summary_key, summary, self.classifier.cache_signature())
+            classification_result = self.cache.get("classification", classification_key)
+        classification_hit = classification_result is not None
+        if not classification_hit:
+            classification_result = self.classifier.classify_document(summary, timer)
+            # "Không có lý do" nghĩa là phản hồi rỗng/sai format, không lưu
+            if self.cache and classification_result["reason"] != "Không có lý do":
+                self.cache.set("classification", classification_key, classification_result)
+        
         classification_result["processing_steps"] = [
             "Trích xuất trang đầu",
             "Tóm tắt nội dung", 
             "Phân loại văn bản"
         ]
+        if self.cache:
+            classification_result["cache"] = {
+                "summary_hit": summary_hit,
+                "classification_hit": classification_hit,
+                **self.cache.stats()
+            }
+        
+        return classification_result
+    
+    def _classify_single_call(self, first_page_text: str, show_progress: bool, pdf_hash: str, mode: str,
+                              timer: StageTimer) -> Dict:
+        # Bước 2: Phân loại trực tiếp trên văn bản gốc, một lần gọi LLM
+        if show_progress:
+            print("Đang phân loại văn bản...")
+        if mode == "constrained":
+            classify, signature = self.classifier.classify_constrained, self.classifier.constrained_cache_signature()
+        else:
+            classify, signature = self.classifier.classify_direct, self.classifier.direct_cache_signature()
+        
+        single_key = None
+        classification_result = None
+        if self.cache:
+            single_key = hash_key(pdf_hash, first_page_text, signature)
+            classification_result = self.cache.get(mode, single_key)
+        classification_hit = classification_result is not None
+        if not classification_hit:
+            classification_result = classify(first_page_text, timer)
+            if "error" in classification_result:
+                return classification_result
+            if self.cache and classification_result["reason"] != "Không có lý do":
+                self.cache.set(mode, single_key, classification_result)
+        
+        classification_result["processing_steps"] = [
+            "Trích xuất trang đầu",
+            "Phân loại văn bản"
+        ]
+        if self.cache:
+            classification_result["cache"] = {
+                "classification_hit": classification_hit,
+                **self.cache.stats()
+            }
         
         return classification_result
+    
+    def analyze_many(self, pdf_paths: Iterable[str], extract_workers: int = None,
+                     max_in_flight: int = 4, mode: str = "summarize") -> Iterator[Dict]:
+        """Phân tích nhiều PDF, trả về kết quả theo thứ tự hoàn thành
+
+        Trích xuất chạy trong process pool, các lời gọi LLM chạy song song
+        tối đa `max_in_flight` tài liệu cùng lúc.
+        """
+        return run_pipeline(self, pdf_paths, extract_workers=extract_workers,
+                            max_in_flight=max_in_flight, mode=mode)
 
 # Ví dụ sử dụng
-analyzer = DocumentAnalyzer("http://localhost:8080")
-result = analyzer.analyze_document("document.pdf")
-print(json.dumps(result, ensure_ascii=False, indent=2))
\ No newline at end of file
+if __name__ == "__main__":
+    analyzer = DocumentAnalyzer("http://localhost:8080")
+    result = analyzer.analyze_document("document.pdf")
+    print(json.dumps(result, ensure_ascii=False, indent=2))
\ No newline at end of file
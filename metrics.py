@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return "\n".join(lines)
+
+class MetricsRegistry:
+    """Tập metric của process, xuất theo Prometheus text format 0.0.4"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "document_stage_seconds", "Thời gian từng bước xử lý tài liệu", ["stage"])
+DOCUMENTS_TOTAL = REGISTRY.counter(
+    "documents_total", "Số tài liệu đã phân tích", ["engine", "mode", "status"])
+LLM_TOKENS_TOTAL = REGISTRY.counter(
+    "llm_tokens_total", "Số token llama-server đã xử lý", ["stage", "kind"])
+LLM_SERVER_SECONDS_TOTAL = REGISTRY.counter(
+    "llm_server_seconds_total", "Thời gian llama-server báo cáo (prompt eval / sinh token)", ["stage", "phase"])
+
+class StageTimer:
+    """Thời gian từng bước và usage LLM của một tài liệu"""
+
+    def __init__(self, on_stage: Callable[[str, float], None] = None):
+        self.timings: Dict[str, float] = {}
+        self.llm: Dict[str, Dict] = {}
+        # on_stage(tên bước, ms) được gọi mỗi khi một bước kết thúc (ví dụ để stream tiến độ)
+        self.on_stage = on_stage
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.timings[f"{name}_ms"] = self.timings.get(f"{name}_ms", 0.0) + elapsed_ms
+            if self.on_stage is not None:
+                self.on_stage(name, elapsed_ms)
+
+    def record_llm(self, stage: str, usage: Dict):
+        if usage:
+            self.llm[stage] = dict(usage)
+
+def record_analysis(result: Dict, timer: StageTimer):
+    """Cộng dồn thời gian/token của một kết quả phân tích vào metric của process"""
+    for name, ms in timer.timings.items():
+        STAGE_SECONDS.observe(ms / 1000, stage=name[:-3])
+    for stage, usage in timer.llm.items():
+        LLM_TOKENS_TOTAL.inc(usage.get("prompt_tokens", 0), stage=stage, kind="prompt")
+        LLM_TOKENS_TOTAL.inc(usage.get("predicted_tokens", 0), stage=stage, kind="predicted")
+        LLM_TOKENS_TOTAL.inc(usage.get("cached_tokens", 0), stage=stage, kind="cached")
+        LLM_SERVER_SECONDS_TOTAL.inc(usage.get("prompt_ms", 0.0) / 1000, stage=stage, phase="prompt")
+        LLM_SERVER_SECONDS_TOTAL.inc(usage.get("predicted_ms", 0.0) / 1000, stage=stage, phase="predict")
+        LLM_SERVER_SECONDS_TOTAL.inc(usage.get("prompt_ms_saved", 0.0) / 1000, stage=stage, phase="prompt_saved")
+    DOCUMENTS_TOTAL.inc(engine=result.get("engine", "none"), mode=result.get("mode", ""),
+                        status="error" if "error" in result else "ok")
@@ -0,0 +1,186 @@
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Union
+
+import fitz
+
+from extraction import truncate_to_tokens
+from ingest import PdfSource
+from metrics import REGISTRY, StageTimer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+OCR_DOCUMENTS_TOTAL = REGISTRY.counter(
+    "ocr_documents_total", "Số tài liệu chạy OCR theo kết quả", ["status"])
+
+_WHITESPACE = re.compile(r"[ \t]+")
+
+class OcrTimeout(Exception):
+    """OCR một tài liệu vượt quá giới hạn thời gian"""
+
+def _tesseract(png: bytes, lang: str, dpi: int, timeout: float) -> str:
+    # tesseract đọc ảnh từ stdin và ghi text ra stdout, không cần file tạm
+    try:
+        completed = subprocess.run(["tesseract", "stdin", "stdout", "-l", lang, "--dpi", str(dpi), "--psm", "3"],
+                                   input=png, capture_output=True, timeout=timeout, check=True)
+    except subprocess.TimeoutExpired:
+        raise OcrTimeout(f"Tesseract vượt quá {timeout:.1f}s") from None
+    return completed.stdout.decode('utf-8', errors='replace')
+
+def _clean(text: str) -> str:
+    lines = (_WHITESPACE.sub(" ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def _ocr_first_page(source: Union[str, bytes, PdfSource], dpi: int, lang: str, top_ratio: float, min_chars: int,
+                    token_budget: int, time_limit: float) -> str:
+    """Chạy trong process OCR: render trang đầu rồi nhận dạng bằng Tesseract
+
+    Render và nhận dạng phần trên của trang trước (tiêu đề, trích yếu thường nằm ở đó);
+    chỉ khi phần này có ít hơn `min_chars` ký tự mới OCR tiếp phần còn lại.
+    Giới hạn thời gian tính từ lúc process bắt đầu xử lý tài liệu.
+    """
+    if isinstance(source, PdfSource):
+        with source.buffer() as data:
+            return _ocr_first_page(data, dpi, lang, top_ratio, min_chars, token_budget, time_limit)
+
+    deadline = time.monotonic() + time_limit
+    if isinstance(source, str):
+        doc = fitz.open(source)
+    else:
+        doc = fitz.open(stream=source, filetype="pdf")
+    with doc:
+        if doc.page_count == 0:
+            return ""
+        page = doc.load_page(0)
+        rect = page.rect
+        if top_ratio >= 1.0:
+            regions = [rect]
+        else:
+            split = rect.y0 + rect.height * top_ratio
+            regions = [fitz.Rect(rect.x0, rect.y0, rect.x1, split), fitz.Rect(rect.x0, split, rect.x1, rect.y1)]
+
+        parts = []
+        for clip in regions:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise OcrTimeout(f"OCR vượt quá {time_limit:.1f}s")
+            pixmap = page.get_pixmap(dpi=dpi, clip=clip, colorspace=fitz.csGRAY, alpha=False)
+            text = _clean(_tesseract(pixmap.tobytes("png"), lang, dpi, remaining))
+            if text:
+                parts.append(text)
+            if sum(len(part) for part in parts) >= min_chars:
+                break
+    return truncate_to_tokens("\n".join(parts), token_budget)
+
+class OcrEngine:
+    """OCR trang đầu cho PDF không có lớp text (bản scan), chạy trong process pool riêng
+
+    Pool riêng giới hạn số tài liệu OCR đồng thời (`workers`), nên OCR nặng
+    không chiếm CPU/GIL của luồng trích xuất text và các request khác.
+    Mỗi tài liệu bị giới hạn `timeout` giây xử lý; quá hạn thì coi như không có text.
+    Người gọi chờ tối đa `result_timeout` (timeout + thời gian khởi động process), nên
+    process render/OCR bị treo không chặn luồng gọi mãi.
+    Pool được tạo ở lần OCR đầu tiên, tạo lại nếu process bị fork hoặc pool hỏng.
+    """
+
+    # Thời gian chờ thêm ngoài giới hạn OCR: khởi động process spawn, import fitz, xếp hàng trong pool
+    startup_grace = 30.0
+
+    def __init__(self, workers: int = 2, dpi: int = 200, lang: str = "vie", top_ratio: float = 0.4,
+                 min_chars: int = 100, token_budget: int = 600, timeout: float = 30.0):
+        self.workers = workers
+        self.dpi = dpi
+        self.lang = lang
+        self.top_ratio = top_ratio
+        self.min_chars = min_chars
+        self.token_budget = token_budget
+        self.timeout = timeout
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.available = shutil.which("tesseract") is not None
+        if not self.available:
+            logging.warning("tesseract not found in PATH, OCR fallback disabled")
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # spawn: không fork process đang có nhiều thread (server, HTTP pool)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+                self._pid = os.getpid()
+            return self._pool
+
+    @property
+    def result_timeout(self) -> float:
+        return self.timeout + self.startup_grace
+
+    def submit(self, source: Union[str, bytes, PdfSource]) -> Future:
+        """Gửi PDF (đường dẫn, bytes hoặc PdfSource) vào pool OCR, trả về Future của text"""
+        args = (_ocr_first_page, source, self.dpi, self.lang, self.top_ratio, self.min_chars, self.token_budget,
+                self.timeout)
+        pool = self._executor()
+        try:
+            return pool.submit(*args)
+        except BrokenProcessPool:
+            # Process OCR từng chết giữa chừng (hết bộ nhớ, bị kill): pool không dùng lại được, tạo pool mới
+            logging.warning("OCR process pool broken, recreating")
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return self._executor().submit(*args)
+
+    def result(self, future: Future, timeout: Optional[float] = None) -> str:
+        """Text OCR của future, chờ tối đa `timeout` giây (mặc định result_timeout)
+
+        Lỗi/quá thời gian trả "" để tài liệu đi tiếp như PDF rỗng.
+        """
+        timeout = self.result_timeout if timeout is None else timeout
+        try:
+            text = future.result(timeout=timeout)
+        except OcrTimeout as e:
+            logging.warning(f"OCR timed out: {e}")
+            OCR_DOCUMENTS_TOTAL.inc(status="timeout")
+            return ""
+        except TimeoutError:
+            # Render/process bị treo: bỏ qua tài liệu, process treo không chặn người gọi
+            future.cancel()
+            logging.warning(f"OCR produced no result in time (limit {self.result_timeout:.1f}s)")
+            OCR_DOCUMENTS_TOTAL.inc(status="timeout")
+            return ""
+        except BrokenProcessPool as e:
+            logging.error(f"OCR process pool broken: {e}")
+            OCR_DOCUMENTS_TOTAL.inc(status="error")
+            return ""
+        except Exception as e:
+            logging.error(f"Error running OCR: {e}")
+            OCR_DOCUMENTS_TOTAL.inc(status="error")
+            return ""
+        OCR_DOCUMENTS_TOTAL.inc(status="ok" if text else "empty")
+        return text
+
+    def extract(self, source: Union[str, bytes, PdfSource], timer: Optional[StageTimer] = None) -> str:
+        """OCR trang đầu và chờ kết quả (thread gọi chỉ chờ, việc nặng chạy ở process khác)"""
+        if not self.available:
+            return ""
+        timer = timer or StageTimer()
+        with timer.stage("ocr"):
+            return self.result(self.submit(source))
+
+    def stats(self) -> Dict:
+        return {"available": self.available, "workers": self.workers, "dpi": self.dpi, "lang": self.lang,
+                "timeout": self.timeout}
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,236 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import random
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+from taxonomy import Taxonomy, load_taxonomy
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa Unicode (NFC), chữ thường, gộp khoảng trắng"""
+    text = unicodedata.normalize('NFC', text).lower()
+    return re.sub(r'\s+', ' ', text).strip()
+
+class FastClassifier:
+    """Bộ phân loại cục bộ: TF-IDF n-gram ký tự (hashing) + hồi quy logistic đa lớp
+
+    Chạy hoàn toàn trên CPU, không cần thư viện ngoài. Model lưu dạng JSON
+    chỉ gồm các trọng số khác 0, kèm tên loại của từng lớp (`labels`, id loại -> tên)
+    để kiểm tra model khớp taxonomy đang dùng.
+    """
+
+    def __init__(self, n_classes: int = 2, n_features: int = 2 ** 18, ngram_range: Tuple[int, int] = (2, 4),
+                 max_chars: int = 2000, labels: Dict[int, str] = None):
+        self.n_classes = n_classes
+        self.labels = labels or {}
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.max_chars = max_chars
+        self.idf: Dict[int, float] = {}
+        self.weights: Dict[int, List[float]] = {}
+        self.bias = [0.0] * n_classes
+
+    def _hashed_counts(self, text: str) -> Counter:
+        text = " " + normalize_text(text[:self.max_chars]) + " "
+        counts = Counter()
+        n_min, n_max = self.ngram_range
+        for n in range(n_min, n_max + 1):
+            for i in range(len(text) - n + 1):
+                counts[zlib.crc32(text[i:i + n].encode('utf-8')) % self.n_features] += 1
+        return counts
+
+    def vectorize(self, text: str) -> Dict[int, float]:
+        """Vector TF-IDF (tf log, chuẩn hóa L2), chỉ giữ feature có trong IDF"""
+        vector = {}
+        for index, count in self._hashed_counts(text).items():
+            idf = self.idf.get(index)
+            if idf is not None:
+                vector[index] = (1.0 + math.log(count)) * idf
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        if norm > 0:
+            vector = {index: v / norm for index, v in vector.items()}
+        return vector
+
+    def _scores(self, vector: Dict[int, float]) -> List[float]:
+        scores = list(self.bias)
+        for index, value in vector.items():
+            w = self.weights.get(index)
+            if w is not None:
+                for c in range(self.n_classes):
+                    scores[c] += w[c] * value
+        return scores
+
+    @staticmethod
+    def _softmax(scores: List[float]) -> List[float]:
+        top = max(scores)
+        exps = [math.exp(s - top) for s in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def predict_proba(self, text: str) -> List[float]:
+        return self._softmax(self._scores(self.vectorize(text)))
+
+    def predict(self, text: str) -> Tuple[int, float]:
+        """Trả về (nhãn, xác suất)"""
+        probs = self.predict_proba(text)
+        label = max(range(self.n_classes), key=lambda c: probs[c])
+        return label, probs[label]
+
+    def fit(self, texts: List[str], labels: List[int], epochs: int = 30, learning_rate: float = 0.5,
+            l2: float = 1e-4, seed: int = 0) -> "FastClassifier":
+        """Huấn luyện bằng SGD trên cross-entropy đa lớp"""
+        counts = [self._hashed_counts(text) for text in texts]
+
+        # IDF làm mịn như sklearn: log((1 + N) / (1 + df)) + 1
+        document_frequency = Counter()
+        for c in counts:
+            document_frequency.update(c.keys())
+        n_docs = len(texts)
+        self.idf = {index: math.log((1 + n_docs) / (1 + df)) + 1.0 for index, df in document_frequency.items()}
+
+        vectors = [self.vectorize(text) for text in texts]
+        self.weights = {}
+        self.bias = [0.0] * self.n_classes
+        order = list(range(n_docs))
+        rng = random.Random(seed)
+
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            lr = learning_rate / (1.0 + epoch * 0.1)
+            for i in order:
+                vector, label = vectors[i], labels[i]
+                probs = self._softmax(self._scores(vector))
+                grads = [probs[c] - (1.0 if c == label else 0.0) for c in range(self.n_classes)]
+                for c in range(self.n_classes):
+                    self.bias[c] -= lr * grads[c]
+                for index, value in vector.items():
+                    w = self.weights.setdefault(index, [0.0] * self.n_classes)
+                    for c in range(self.n_classes):
+                        w[c] -= lr * (grads[c] * value + l2 * w[c])
+
+        # Bỏ trọng số ~0 cho model gọn; IDF chỉ cần cho feature có trọng số
+        self.weights = {index: w for index, w in self.weights.items() if any(abs(x) > 1e-6 for x in w)}
+        self.idf = {index: idf for index, idf in self.idf.items() if index in self.weights}
+        return self
+
+    def save(self, path: str):
+        model = {
+            "n_classes": self.n_classes,
+            "n_features": self.n_features,
+            "ngram_range": list(self.ngram_range),
+            "max_chars": self.max_chars,
+            "labels": {str(class_id): label for class_id, label in sorted(self.labels.items())},
+            "bias": [round(b, 6) for b in self.bias],
+            "idf": {str(index): round(idf, 6) for index, idf in self.idf.items()},
+            "weights": {str(index): [round(x, 6) for x in w] for index, w in self.weights.items()}
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(model, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str) -> "FastClassifier":
+        with open(path, encoding='utf-8') as f:
+            model = json.load(f)
+        labels = {int(class_id): label for class_id, label in model.get("labels", {}).items()}
+        classifier = cls(model["n_classes"], model["n_features"], tuple(model["ngram_range"]), model["max_chars"],
+                         labels)
+        classifier.bias = model["bias"]
+        classifier.idf = {int(index): idf for index, idf in model["idf"].items()}
+        classifier.weights = {int(index): w for index, w in model["weights"].items()}
+        return classifier
+
+    def matches(self, categories: Dict[int, str]) -> bool:
+        """Mọi lớp của model có cùng id và tên với một loại trong `categories` (taxonomy đang dùng)
+
+        Model cũ không lưu labels được coi là huấn luyện trên phân loại mặc định (nhãn 0/1 của data.txt).
+        """
+        labels = self.labels or Taxonomy.default().categories
+        return all(categories.get(class_id) == label for class_id, label in labels.items())
+
+def load_data_txt(path: str) -> Tuple[List[str], List[int]]:
+    """Đọc data.txt: mỗi khối (cách nhau bởi dòng trống) là một nhãn, theo thứ tự 0, 1, ..."""
+    texts, labels = [], []
+    label = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                if texts and labels[-1] == label:
+                    label += 1
+                continue
+            texts.append(line.strip('"'))
+            labels.append(label)
+    return texts, labels
+
+def load_jsonl(path: str) -> Tuple[List[str], List[int]]:
+    """Đọc JSONL có trường "text" và "label" (hoặc "category_id")"""
+    texts, labels = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            label = record.get("label", record.get("category_id"))
+            if record.get("text") and label is not None:
+                texts.append(record["text"])
+                labels.append(int(label))
+    return texts, labels
+
+def load_csv(path: str) -> Tuple[List[str], List[int]]:
+    """Đọc CSV có header, cột "text" và "label" (hoặc "category_id")"""
+    texts, labels = [], []
+    with open(path, encoding='utf-8', newline='') as f:
+        for record in csv.DictReader(f):
+            label = record.get("label") or record.get("category_id")
+            if record.get("text") and label:
+                texts.append(record["text"])
+                labels.append(int(label))
+    return texts, labels
+
+def load_training_data(paths: Iterable[str]) -> Tuple[List[str], List[int]]:
+    texts, labels = [], []
+    for path in paths:
+        if path.endswith('.jsonl'):
+            loader = load_jsonl
+        elif path.endswith('.csv'):
+            loader = load_csv
+        else:
+            loader = load_data_txt
+        t, l = loader(path)
+        texts.extend(t)
+        labels.extend(l)
+    return texts, labels
+
+def main():
+    parser = argparse.ArgumentParser(description="Huấn luyện bộ phân loại cục bộ (TF-IDF n-gram ký tự)")
+    parser.add_argument("data", nargs="+", help="data.txt và/hoặc file JSONL/CSV có nhãn")
+    parser.add_argument("-o", "--output", default="prefilter_model.json", help="File model đầu ra")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--taxonomy", default=None,
+                        help="File JSON cây loại tài liệu mà nhãn dữ liệu tham chiếu (mặc định: Thông báo / Tài chính)")
+    args = parser.parse_args()
+
+    texts, labels = load_training_data(args.data)
+    categories = load_taxonomy(args.taxonomy).categories
+    unknown = sorted(set(labels) - set(categories))
+    if unknown:
+        parser.error(f"Nhãn không có trong taxonomy: {unknown}")
+    n_classes = max(labels) + 1
+    classifier = FastClassifier(n_classes=n_classes, labels={label: categories[label] for label in set(labels)})
+    classifier.fit(texts, labels, epochs=args.epochs)
+    classifier.save(args.output)
+
+    correct = sum(classifier.predict(text)[0] == label for text, label in zip(texts, labels))
+    logging.info(f"Trained on {len(texts)} samples, {len(classifier.weights)} features, "
+                 f"train accuracy {correct / len(texts):.2%} -> {args.output}")
+
+if __name__ == "__main__":
+    main()
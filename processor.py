@@ -1,44 +1,78 @@
 from client import Qwen3Client
+from extraction import LayoutExtractor
+from metrics import StageTimer
 import logging
 import fitz
-from typing import Dict, List
+from typing import Dict, List, Union
 import json
 import os
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class DocumentProcessor:
-    def __init__(self, qwen_client: Qwen3Client):
+    # Hướng dẫn cố định ở đầu, văn bản ở cuối để tái sử dụng prefix KV cache
+    summary_prompt = """Hãy tóm tắt nội dung văn bản sau thành 2-3 câu ngắn gọn, tập trung vào thông tin chính:
+
+Văn bản:
+{text}
+
+Tóm tắt:"""
+    summary_max_tokens = 200
+    summary_temperature = 0.1
+    max_input_chars = 2000
+
+    def __init__(self, qwen_client: Qwen3Client, extractor: LayoutExtractor = None):
         self.qwen_client = qwen_client
+        self.extractor = extractor or LayoutExtractor()
     
-    def extract_first_page(self, pdf_path: str) -> str:
+    def extract_first_page(self, pdf_path: str, timer: StageTimer = None) -> str:
         """Trích xuất text từ trang đầu PDF bằng PyMuPDF"""
+        timer = timer or StageTimer()
         try:
-            doc = fitz.open(pdf_path)
-            if doc.page_count > 0:
-                page = doc.load_page(0)  # Trang đầu tiên (index 0)
-                text = page.get_text()
-                return text.strip()
+            with timer.stage("pdf_open"):
+                doc = fitz.open(pdf_path)
+            with doc:
+                return self._extract_first_page_text(doc, timer)
+        except Exception as e:
+            logging.error(f"Error extracting PDF with PyMuPDF: {e}")
             return ""
+    
+    def extract_first_page_from_bytes(self, data: Union[bytes, memoryview], timer: StageTimer = None) -> str:
+        """Trích xuất text từ trang đầu PDF nằm trong bộ nhớ (bytes hoặc memoryview trên mmap, không ghi ra đĩa)"""
+        timer = timer or StageTimer()
+        try:
+            with timer.stage("pdf_open"):
+                doc = fitz.open(stream=data, filetype="pdf")
+            with doc:
+                return self._extract_first_page_text(doc, timer)
         except Exception as e:
             logging.error(f"Error extracting PDF with PyMuPDF: {e}")
             return ""
     
-    def summarize_text(self, text: str) -> str:
+    def _extract_first_page_text(self, doc, timer: StageTimer) -> str:
+        # Tiêu đề + đoạn đầu trong ngân sách token; chỉ đọc thêm trang sau khi trang đầu gần như trống
+        with timer.stage("page_extract"):
+            return self.extractor.extract(doc)
+    
+    def summarize_text(self, text: str, timer: StageTimer = None) -> str:
         """Tóm tắt văn bản sử dụng Qwen3"""
         if len(text) < 100:
             return text
         
         # Cắt text nếu quá dài (tránh vượt quá context length)
-        if len(text) > 2000:
-            text = text[:2000] + "..."
+        if len(text) > self.max_input_chars:
+            text = text[:self.max_input_chars] + "..."
         
-        prompt = f"""Hãy tóm tắt nội dung văn bản sau thành 2-3 câu ngắn gọn, tập trung vào thông tin chính:
-
-Văn bản:
-{text}
-
-Tóm tắt:"""
+        prompt = self.summary_prompt.format(text=text)
         
-        summary = self.qwen_client.generate_text(prompt, max_tokens=200, temperature=0.1)
-        return summary if summary else text[:500]
\ No newline at end of file
+        timer = timer or StageTimer()
+        with timer.stage("summarize"):
+            summary = self.qwen_client.generate_text(prompt, max_tokens=self.summary_max_tokens,
+                                                     temperature=self.summary_temperature)
+        timer.record_llm("summarize", self.qwen_client.last_usage)
+        return summary if summary else text[:500]
+    
+    def cache_signature(self) -> str:
+        """Định danh prompt + tham số tóm tắt, dùng làm một phần khóa cache"""
+        return json.dumps([self.summary_prompt, self.summary_max_tokens,
+                           self.summary_temperature, self.max_input_chars], ensure_ascii=False)
\ No newline at end of file
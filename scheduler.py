@@ -0,0 +1,152 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from backends import LLMError
+from client import Qwen3Client, set_last_usage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class _PendingPrompt:
+    __slots__ = ("prompt", "params", "key", "future")
+
+    def __init__(self, prompt: str, params: Dict):
+        self.prompt = prompt
+        self.params = params
+        # Chỉ gộp các prompt có cùng tham số sinh (n_predict, temperature, grammar, ...)
+        self.key = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        self.future = Future()
+
+class BatchingClient:
+    """Gom các prompt đồng thời thành batch trước khi gửi tới llama-server
+
+    Thay thế trực tiếp cho Qwen3Client (cùng generate_text/complete/last_usage),
+    nên DocumentProcessor/DocumentClassifier dùng được không cần sửa.
+    Prompt được giữ tối đa max_wait_ms hoặc tới khi đủ max_batch rồi gửi:
+    - multi_prompt=True: cả batch trong một request (prompt dạng list)
+    - multi_prompt=False: từng prompt, rải đều trên `slots` request song song
+    Tối đa `slots` request HTTP đang chạy cùng lúc, tính cả request stream
+    (dừng sớm) được gửi thẳng; khi hết slot, prompt mới tiếp tục dồn lại nên
+    batch sau tự lớn hơn.
+    """
+
+    def __init__(self, client: Qwen3Client, max_wait_ms: float = 5.0, max_batch: int = 8, slots: int = 4,
+                 multi_prompt: bool = True):
+        self.client = client
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.slots = slots
+        self.multi_prompt = multi_prompt
+
+        self._queue = queue.Queue()
+        self._free_slots = threading.Semaphore(slots)
+        self._executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="llm-slot")
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="llm-batcher", daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+
+    @property
+    def last_usage(self) -> Dict:
+        return self.client.last_usage
+
+    def health(self) -> Dict:
+        return self.client.health()
+
+    def generate_text(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                      stop_when: Callable[[str], bool] = None) -> str:
+        if stop_when is not None:
+            result = self.stream_complete(prompt, max_tokens, temperature, enable_thinking, stop_when=stop_when)
+        else:
+            result = self.complete(prompt, max_tokens, temperature, enable_thinking)
+        return result.get("content", "").strip()
+
+    def stream_complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1,
+                        enable_thinking: bool = False, stop_when: Callable[[str], bool] = None, **options) -> Dict:
+        # Stream dừng sớm không gộp batch được: gửi thẳng, nhưng vẫn chiếm một slot như request batch
+        with self._free_slots:
+            return self.client.stream_complete(prompt, max_tokens, temperature, enable_thinking,
+                                               stop_when=stop_when, **options)
+
+    def complete(self, prompt: str, max_tokens: int = 512, temperature: float = 0.1, enable_thinking: bool = False,
+                 **options) -> Dict:
+        params = dict(options, max_tokens=max_tokens, temperature=temperature, enable_thinking=enable_thinking)
+        pending = _PendingPrompt(prompt, params)
+        self._queue.put(pending)
+        try:
+            result, usage = pending.future.result()
+        except LLMError as e:
+            set_last_usage({"error": str(e)})
+            raise
+        except Exception as e:
+            logging.error(f"Error in batched Qwen3 request: {e}")
+            set_last_usage({"error": str(e)})
+            raise LLMError(str(e)) from e
+        set_last_usage(usage)
+        return result
+
+    def _dispatch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch * self.slots:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Lấy thêm những gì đã chờ sẵn trong hàng đợi, không đợi thêm
+            while len(batch) < self.max_batch * self.slots:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for pending in batch:
+                groups.setdefault(pending.key, []).append(pending)
+
+            chunk_size = self.max_batch if self.multi_prompt else 1
+            for items in groups.values():
+                for i in range(0, len(items), chunk_size):
+                    self._free_slots.acquire()
+                    self._executor.submit(self._send, items[i:i + chunk_size])
+
+    def _send(self, items: List[_PendingPrompt]):
+        try:
+            params = dict(items[0].params)
+            max_tokens = params.pop("max_tokens")
+            temperature = params.pop("temperature")
+            enable_thinking = params.pop("enable_thinking")
+
+            if len(items) == 1:
+                result = self.client.complete(items[0].prompt, max_tokens, temperature, enable_thinking, **params)
+                outputs = [(result, self.client.last_usage)]
+            else:
+                outputs = self.client.complete_many([item.prompt for item in items], max_tokens, temperature,
+                                                    enable_thinking, **params)
+            for item, output in zip(items, outputs):
+                item.future.set_result(output)
+        except Exception as e:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        finally:
+            self._free_slots.release()
+
+    def stats(self) -> Dict:
+        return {
+            "pending": self._queue.qsize(),
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch": self.max_batch,
+            "slots": self.slots,
+            "multi_prompt": self.multi_prompt
+        }
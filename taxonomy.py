@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+# Mã của một nút là vị trí của nó trong nhóm cha (một chữ số), nên mỗi nhóm tối đa 10 nút con
+MAX_CHILDREN = 10
+
+# Phân loại mặc định: hai loại phẳng như trước khi có cấu hình taxonomy
+DEFAULT_TAXONOMY = {
+    "name": "default",
+    "categories": [
+        {"id": 0, "label": "Thông báo", "description": "thông báo nội bộ, công văn, hướng dẫn, quy định"},
+        {"id": 1, "label": "Tài chính",
+         "description": "báo cáo tài chính, bảng cân đối kế toán, báo cáo doanh thu, lợi nhuận"}
+    ]
+}
+
+class TaxonomyNode:
+    """Một nút của cây phân loại: nhóm (có children) hoặc loại cụ thể (có id)"""
+
+    def __init__(self, label: str, description: str = "", category_id: int = None,
+                 children: List["TaxonomyNode"] = None, code: str = "", path: List[str] = None):
+        self.label = label
+        self.description = description
+        self.category_id = category_id
+        self.children = children or []
+        # Mã trả lời của nút trong chế độ constrained, ví dụ "1" (nhóm) hoặc "1.0" (loại trong nhóm 1)
+        self.code = code
+        self.path = path or []
+
+    @property
+    def is_leaf(self) -> bool:
+        return not self.children
+
+    @property
+    def rule_name(self) -> str:
+        # Tên rule GBNF chỉ gồm chữ, số và dấu gạch ngang
+        return "node-" + self.code.replace(".", "-") if self.code else "root"
+
+    def describe(self) -> str:
+        return f"{self.label} ({self.description})" if self.description else self.label
+
+class Taxonomy:
+    """Cây loại tài liệu đọc từ cấu hình JSON, biên dịch sẵn thành prompt và grammar
+
+    Cấu hình: {"name": ..., "categories": [nút, ...]}; mỗi nút có "label",
+    "description" (tùy chọn) và hoặc "id" (loại cụ thể, số nguyên duy nhất),
+    hoặc "children" (nhóm). Các nhóm có thể lồng nhau và độ sâu không cần đều.
+
+    Mọi phần phụ thuộc taxonomy (danh sách loại trong prompt, grammar ràng buộc
+    nhóm -> loại) được tạo một lần khi khởi tạo; phân loại chỉ còn ghép văn bản.
+    """
+
+    def __init__(self, spec: Dict):
+        self.spec = spec
+        self.name = spec.get("name", "")
+        self.root = TaxonomyNode("", children=self._build(spec.get("categories", []), "", []))
+        if not self.root.children:
+            raise ValueError("Taxonomy cần ít nhất một loại")
+
+        self.nodes_by_code: Dict[str, TaxonomyNode] = {}
+        self.leaves: Dict[int, TaxonomyNode] = {}
+        self._index(self.root)
+        self.depth = max(len(node.path) for node in self.leaves.values())
+        self.categories = {category_id: node.label for category_id, node in self.leaves.items()}
+
+        # Biên dịch sẵn: danh sách loại theo id (trả lời tự do) và theo mã (constrained)
+        self.leaf_instructions = self._render(by_code=False)
+        self.code_instructions = self._render(by_code=True)
+        self.leaf_choices = _choices([str(category_id) for category_id in sorted(self.leaves)])
+        self.grammar = self._compile_grammar()
+        # Mã dài nhất "d.d.d" = 2 * độ sâu - 1 token
+        self.max_code_tokens = 2 * self.depth - 1
+
+    @classmethod
+    def default(cls) -> "Taxonomy":
+        return cls(DEFAULT_TAXONOMY)
+
+    @classmethod
+    def from_file(cls, path: str) -> "Taxonomy":
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def _build(self, items: List[Dict], parent_code: str, parent_path: List[str]) -> List[TaxonomyNode]:
+        if len(items) > MAX_CHILDREN:
+            raise ValueError(f"Nhóm '{parent_path[-1] if parent_path else 'gốc'}' có {len(items)} loại, "
+                             f"tối đa {MAX_CHILDREN}; hãy chia thành các nhóm con")
+        nodes = []
+        for index, item in enumerate(items):
+            code = f"{parent_code}.{index}" if parent_code else str(index)
+            path = parent_path + [item["label"]]
+            children = item.get("children")
+            if children and "id" in item:
+                raise ValueError(f"Nút '{item['label']}' không được có cả id và children")
+            if not children and "id" not in item:
+                raise ValueError(f"Loại '{item['label']}' thiếu id")
+            node = TaxonomyNode(item["label"], item.get("description", ""),
+                                None if children else int(item["id"]), code=code, path=path)
+            if children:
+                node.children = self._build(children, code, path)
+            nodes.append(node)
+        return nodes
+
+    def _index(self, node: TaxonomyNode):
+        for child in node.children:
+            self.nodes_by_code[child.code] = child
+            if child.is_leaf:
+                if child.category_id in self.leaves:
+                    raise ValueError(f"Trùng id loại: {child.category_id}")
+                self.leaves[child.category_id] = child
+            else:
+                self._index(child)
+
+    def _render(self, by_code: bool) -> str:
+        if by_code and self.depth > 1:
+            header = "Phân loại văn bản: chọn nhóm trước, rồi chọn loại cụ thể trong nhóm đó:\n"
+        else:
+            header = "Phân loại văn bản thuộc loại nào:\n"
+        lines = []
+
+        def walk(node: TaxonomyNode, indent: str):
+            for child in node.children:
+                if child.is_leaf:
+                    key = child.code if by_code else child.category_id
+                    lines.append(f"{indent}- Loại {key}: {child.describe()}")
+                elif by_code:
+                    lines.append(f"{indent}- Nhóm {child.code}: {child.describe()}")
+                else:
+                    lines.append(f"{indent}- Nhóm {child.describe()}:")
+                if not child.is_leaf:
+                    walk(child, indent + "  ")
+
+        walk(self.root, "")
+        return header + "\n".join(lines) + "\n\n"
+
+    def _compile_grammar(self) -> str:
+        """GBNF: mỗi nhóm là một rule chọn mã nút con; chọn nhóm xong chỉ được chọn loại thuộc nhóm đó"""
+        rules = []
+
+        def walk(node: TaxonomyNode):
+            alternatives = []
+            for child in node.children:
+                digit = child.code.rsplit(".", 1)[-1]
+                alternatives.append(f'"{digit}"' if child.is_leaf else f'"{digit}" "." {child.rule_name}')
+            rules.append(f"{node.rule_name} ::= " + " | ".join(alternatives))
+            for child in node.children:
+                if not child.is_leaf:
+                    walk(child)
+
+        walk(self.root)
+        return "\n".join(rules)
+
+    def answer_instruction(self) -> str:
+        """Câu hướng dẫn định dạng trả lời cho chế độ constrained"""
+        if self.depth == 1:
+            return f"Trả lời chỉ bằng một chữ số ({_choices([child.code for child in self.root.children])})."
+        return ("Trả lời chỉ bằng mã loại: chữ số của nhóm, dấu chấm, rồi chữ số của loại trong nhóm "
+                f"(ví dụ {self._example_code()}).")
+
+    def _example_code(self) -> str:
+        node = next(child for child in self.root.children if not child.is_leaf)
+        while not node.is_leaf:
+            node = node.children[0]
+        return node.code
+
+    def leaf_for_code(self, code: str) -> Optional[TaxonomyNode]:
+        node = self.nodes_by_code.get(code)
+        return node if node is not None and node.is_leaf else None
+
+    def path(self, category_id: int) -> List[str]:
+        node = self.leaves.get(category_id)
+        return list(node.path) if node else []
+
+def _choices(values: List[str]) -> str:
+    if len(values) <= 2:
+        return " hoặc ".join(values)
+    return ", ".join(values[:-1]) + " hoặc " + values[-1]
+
+_loaded: Dict[str, tuple] = {}
+_loaded_lock = threading.Lock()
+
+def load_taxonomy(path: str = None) -> Taxonomy:
+    """Taxonomy từ file JSON (None/"": mặc định), biên dịch một lần và dùng chung cho mọi analyzer
+
+    Cache theo đường dẫn + thời điểm sửa file, nên sửa file cấu hình có hiệu lực ở lần tải sau.
+    """
+    if not path:
+        path, mtime = "", 0.0
+    else:
+        mtime = os.path.getmtime(path)
+    with _loaded_lock:
+        cached = _loaded.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, Taxonomy.from_file(path) if path else Taxonomy.default())
+            _loaded[path] = cached
+        return cached[1]
@@ -0,0 +1,77 @@
+import io
+
+from app import PdfUploadBuffer, create_app
+from benchmark import MockLlamaServer, make_pdf
+from main import DocumentAnalyzer
+
+PDF = make_pdf("Ngân hàng công bố lợi nhuận sau thuế quý ba tăng mạnh nhờ tín dụng và đầu tư")
+
+
+def _classify(analyzer, path="/classify"):
+    client = create_app(analyzer=analyzer).test_client()
+    return client.post(path, data={"document": (io.BytesIO(PDF), "a.pdf"), "mode": "direct"},
+                       content_type="multipart/form-data")
+
+
+def test_shed_request_returns_429_with_retry_after():
+    with MockLlamaServer("instant") as server:
+        analyzer = DocumentAnalyzer(server.url, adaptive_concurrency=True,
+                                    limiter_options={"initial_limit": 1, "max_limit": 1, "max_queue": 0,
+                                                     "queue_timeout": 2.0})
+        # Chiếm lượt duy nhất: request tiếp theo bị từ chối ngay (hàng đợi tối đa 0)
+        analyzer.limiter.acquire()
+        response = _classify(analyzer)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "2"
+        assert response.get_json()["error_kind"] == "overloaded"
+        analyzer.qwen_client.close()
+
+
+def test_dead_backend_returns_503():
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1", client_options={"max_retries": 0, "connect_timeout": 0.5})
+    response = _classify(analyzer)
+    assert response.status_code == 503
+    assert response.get_json()["error_kind"] == "unavailable"
+    analyzer.qwen_client.close()
+
+
+def test_stream_reports_llm_error_as_error_event():
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1", client_options={"max_retries": 0, "connect_timeout": 0.5})
+    response = _classify(analyzer, "/classify/stream")
+    body = response.get_data(as_text=True)
+    assert "event: error" in body and '"status": 503' in body
+    analyzer.qwen_client.close()
+
+
+def test_client_close_stops_health_thread():
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1", client_options={"health_interval": 0.05})
+    thread = analyzer.qwen_client.backends._health_thread
+    assert thread.is_alive()
+    analyzer.qwen_client.close()
+    assert not thread.is_alive()
+
+
+def test_health_does_not_build_services():
+    app = create_app({"LLAMA_SERVER_URLS": "http://127.0.0.1:1"})
+    response = app.test_client().get("/health")
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "starting"
+    assert app.extensions["document_services"].existing() == (None, None)
+
+
+def test_multipart_non_pdf_rejected_while_parsing(monkeypatch):
+    written = []
+    original_write = PdfUploadBuffer.write
+
+    def write(self, data):
+        written.append(len(data))
+        return original_write(self, data)
+
+    monkeypatch.setattr(PdfUploadBuffer, "write", write)
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1")
+    body = b"x" * (4 * 1024 * 1024)
+    response = create_app(analyzer=analyzer).test_client().post(
+        "/classify", data={"document": (io.BytesIO(body), "a.pdf")}, content_type="multipart/form-data")
+    assert response.status_code == 400
+    assert sum(written) < len(body)
+    analyzer.qwen_client.close()
@@ -0,0 +1,33 @@
+from benchmark import MockLlamaServer, check_roundtrip, make_pdf, percentile
+from main import DocumentAnalyzer
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile(values, 0) == 1
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0
+    assert percentile([], 95) == 0.0
+
+
+def test_make_pdf_keeps_vietnamese_text():
+    text = "Ngân hàng Nhà nước điều chỉnh lãi suất để giảm thiểu rủi ro đầu tư"
+    check_roundtrip(make_pdf(text), text)
+
+
+def test_mock_constrained_mode_with_hierarchical_taxonomy():
+    with MockLlamaServer("instant") as server:
+        analyzer = DocumentAnalyzer(server.url, taxonomy_path="taxonomy.example.json")
+        finance = analyzer.analyze_text("Ngân hàng công bố lợi nhuận sau thuế quý ba tăng mạnh",
+                                        show_progress=False, mode="constrained")
+        other = analyzer.analyze_text("Công ty thông báo lịch nghỉ lễ Quốc khánh cho toàn thể nhân viên",
+                                      show_progress=False, mode="constrained")
+        analyzer.qwen_client.close()
+
+    assert "error" not in finance and "error" not in other
+    assert finance["category_path"] == ["Tài chính - kế toán", "Báo cáo tài chính"]
+    assert other["category_path"] == ["Pháp lý - hợp đồng", "Hợp đồng"]
+    assert finance["confidence"] > 0.5
@@ -0,0 +1,27 @@
+import pytest
+
+from evaluate import compute_metrics, format_report
+
+
+def test_non_contiguous_leaf_ids():
+    # Loại lá của taxonomy nhiều cấp: 11, 12, 21; loại 12 không có mẫu và không được dự đoán
+    labels = [11, 11, 21, 21]
+    predictions = [11, 21, 21, -1]
+    metrics = compute_metrics(labels, predictions, [0.9, 0.8, 0.7, 0.0], [11, 12, 21])
+
+    assert metrics["classes"] == [11, 12, 21]
+    assert metrics["confusion_matrix"] == [[1, 0, 1, 0], [0, 0, 0, 0], [0, 0, 1, 1]]
+    assert metrics["invalid"] == 1
+    assert metrics["accuracy"] == pytest.approx(0.5)
+    f1 = {item["class"]: item["f1"] for item in metrics["per_class"]}
+    assert f1[11] == pytest.approx(2 / 3)
+    assert f1[21] == pytest.approx(0.5)
+    assert metrics["macro_f1"] == pytest.approx((2 / 3 + 0.5) / 2)
+    assert metrics["macro_f1_all"] == pytest.approx((2 / 3 + 0.5) / 3)
+    assert "macro-F1 (lớp có mẫu)" in format_report(metrics, {11: "A", 12: "B", 21: "C"})
+
+
+def test_prediction_outside_taxonomy_is_invalid():
+    metrics = compute_metrics([0, 1], [0, 7], [1.0, 1.0], 2)
+    assert metrics["invalid"] == 1
+    assert metrics["confusion_matrix"] == [[1, 0, 0], [0, 0, 1]]
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import time
+
+from jobs import JobStore
+
+
+def _insert_job(path, job_id, owner, heartbeat=None):
+    conn = sqlite3.connect(path)
+    now = time.time()
+    conn.execute("INSERT INTO jobs (id, filename, mode, status, created_at, updated_at, owner) "
+                 "VALUES (?, 'a.pdf', 'direct', 'running', ?, ?, ?)", (job_id, now, now, owner))
+    if heartbeat is not None:
+        conn.execute("INSERT OR REPLACE INTO owners (id, heartbeat) VALUES (?, ?)", (owner, heartbeat))
+    conn.commit()
+    conn.close()
+
+
+def test_jobs_of_dead_owner_fail_on_startup(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    JobStore(path, heartbeat_interval=0).close()
+    _insert_job(path, "stale", "123-old", heartbeat=time.time() - 3600)
+    _insert_job(path, "live", "456-other", heartbeat=time.time())
+
+    store = JobStore(path, heartbeat_interval=0)
+    assert store.get("stale")["status"] == "failed"
+    assert store.get("live")["status"] == "running"
+    store.close()
+
+
+def test_reused_pid_owner_is_treated_as_dead(tmp_path):
+    # Owner cũ dạng PID: PID còn sống (process cha) nhưng không chứng minh được là process đã nhận job
+    path = str(tmp_path / "jobs.db")
+    JobStore(path, heartbeat_interval=0).close()
+    _insert_job(path, "legacy", os.getppid())
+
+    store = JobStore(path, heartbeat_interval=0)
+    assert store.get("legacy")["status"] == "failed"
+    store.close()
+
+
+def test_rebuilding_store_keeps_own_jobs(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    first = JobStore(path, heartbeat_interval=0)
+    first.create("mine", "a.pdf", "direct")
+
+    second = JobStore(path, heartbeat_interval=0)
+    assert second.get("mine")["status"] == "queued"
+    first.close()
+    second.close()
+
+
+def test_heartbeat_fails_jobs_of_owner_that_stopped(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = JobStore(path, heartbeat_interval=0.05, stale_after=0.2)
+    _insert_job(path, "crashed", "789-crashed", heartbeat=time.time())
+    time.sleep(0.5)
+    assert store.get("crashed")["status"] == "failed"
+    store.close()
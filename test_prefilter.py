@@ -0,0 +1,26 @@
+from main import DocumentAnalyzer
+from prefilter import FastClassifier, load_data_txt
+from taxonomy import Taxonomy
+
+
+def _train(path, labels=None):
+    texts, y = load_data_txt("data.txt")
+    FastClassifier(2, labels=labels).fit(texts, y, epochs=3).save(path)
+    return path
+
+
+def test_prefilter_kept_for_matching_taxonomy(tmp_path):
+    path = _train(str(tmp_path / "pf.json"), Taxonomy.default().categories)
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1", prefilter_path=path)
+    assert analyzer.prefilter is not None
+    assert analyzer.prefilter.labels == Taxonomy.default().categories
+    analyzer.qwen_client.close()
+
+
+def test_prefilter_disabled_for_other_taxonomy(tmp_path):
+    # Model cũ (không lưu labels) được hiểu là nhãn 0/1 mặc định, không khớp cây loại ví dụ
+    path = _train(str(tmp_path / "pf.json"))
+    analyzer = DocumentAnalyzer("http://127.0.0.1:1", prefilter_path=path,
+                                taxonomy_path="taxonomy.example.json")
+    assert analyzer.prefilter is None
+    analyzer.qwen_client.close()